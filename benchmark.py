@@ -0,0 +1,81 @@
+""" Per request allocation benchmark
+
+Usage: python benchmark.py [requests]
+
+Reports size and instance dicts of core objects (Request, Response, Handler,
+Session) created for one request, and time per request. Run it on two
+natrix versions to compare.
+"""
+import gc
+import sys
+import time
+import natrix
+from StringIO import StringIO
+
+
+def instance_dict(obj):
+    """ Returns non-empty instance `__dict__` or none """
+    return getattr(obj, "__dict__", None) or None
+
+
+def sizeof(obj):
+    """ Size of object and its instance `__dict__` in bytes """
+    size = sys.getsizeof(obj)
+    if instance_dict(obj) is not None:
+        size += sys.getsizeof(instance_dict(obj))
+    return size
+
+
+def environ():
+    return {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": "/item/12",
+        "QUERY_STRING": "a=b",
+        "HTTP_HOST": "localhost:8080",
+        "HTTP_COOKIE": "session=x; _ga=GA1.2.3; _gid=GA1.2.4",
+        "wsgi.input": StringIO(""),
+        "wsgi.url_scheme": "http",
+    }
+
+
+def main(count):
+    captured = []
+
+    def item(x, id_):
+        captured.extend([x, x.request, x.response, x.session])
+        x.response("item %s" % id_)
+
+    app = natrix.Application([
+        ("/item/<int>", item),
+    ])
+
+    @app.route(":before")
+    def before(x):
+        captured.append(x)
+    # endfold
+
+    def start_response(status, headers):
+        pass
+
+    # Core objects of one request
+    app(environ(), start_response)
+
+    size = sum(map(sizeof, captured))
+    dicts = len([o for o in captured if instance_dict(o) is not None])
+    sys.stdout.write("Core objects: %d bytes per request\n" % size)
+    sys.stdout.write("Instance dicts: %d per request\n" % dicts)
+    # endfold
+
+    # Timing
+    gc.collect()
+    started = time.time()
+    for _ in range(count):
+        app(environ(), start_response)
+    elapsed = time.time() - started
+
+    sys.stdout.write("Time: %.1f us per request\n" % (elapsed / count * 1000000))
+    # endfold
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
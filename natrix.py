@@ -4,23 +4,38 @@ import cgi
 import sys
 import hmac
 import json
+import zlib
 import time
+import types
 import Cookie
 import jinja2
 import string
 import urllib
 import hashlib
+import calendar
+import tempfile
 import urlparse
 import importlib
+import mimetypes
+import threading
 import traceback
+import jinja2.ext
 from glob import glob
+from bisect import bisect_right
+from collections import OrderedDict, MutableMapping
 from time import sleep
 from logging import info, warning, error
 from datetime import datetime
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from google.appengine.ext import db
 from google.appengine.api import memcache, taskqueue
 from google.appengine.api.logservice import logservice
 
+try:
+    from ujson import loads as json_loads  # faster, if installed
+except ImportError:
+    json_loads = json.loads
+
 
 sys.path.append("./packages")
 
@@ -30,110 +45,339 @@ logservice  # for `from natrix import logservice`
 
 __version__ = "0.1.8+"
 METHOD_RE = "[a-z-]+"
+GROUP_RE = re.compile("""
+  \\(        # `(` character. Marks group start
+  (
+    [^\\)]+  # Until ")" character
+  )
+  \\)        # `)` character. Marks group ends
+""", re.VERBOSE)
+PLACEHOLDER_INT = "(int:\\d+)"
+PLACEHOLDER_STRING = "([^/]+)"
+PLACEHOLDER_RE = re.compile("(%s|%s)" % (
+    re.escape(PLACEHOLDER_INT), re.escape(PLACEHOLDER_STRING),
+))
+LITERAL_RE = re.compile("^[^\\\\.^$*+?{}\\[\\]|()\\x00]*$")
+UNSAFE_HEADER_RE = re.compile("[^\\x20-\\x7e\\t]")
+ETAG_RE = re.compile("^[\\x21\\x23-\\x7e]+\\Z")
+COMPRESS_TYPES = [
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+]
+JINJA_GLOBALS = {
+    "dir": dir,
+    "int": int,
+    "bool": bool,
+    "float": float,
+    "list": list,
+    "reversed": reversed,
+    "sorted": sorted,
+    "max": max,
+    "min": min,
+
+    "json": json,
+    "time": time,
+    "environ": os.environ,
+}
+HTTP_STATUS = {
+    # 1xx
+    100: "100 Continue",
+    101: "101 Switching Protocols",
+    102: "102 Processing",
+    # 2xx
+    200: "200 OK",
+    201: "201 Created",
+    202: "202 Accepted",
+    203: "203 Non-Authoritative Information",
+    204: "204 No Content",
+    205: "205 Reset Content",
+    206: "206 Partial Content",
+    207: "207 Multi-Status",
+    208: "208 Already Reported",
+    226: "226 IM Used",
+    # 3xx
+    300: "300 Multiple Choices",
+    301: "301 Moved Permanently",
+    302: "302 Found",
+    303: "303 See Other",
+    304: "304 Not Modified",
+    305: "305 Use Proxy",
+    306: "306 Switch Proxy",
+    307: "307 Temporary Redirect",
+    308: "308 Permanent Redirect",
+    # 4xx
+    400: "400 Bad Request",
+    401: "401 Unauthorized",
+    402: "402 Payment Required",
+    403: "403 Forbidden",
+    404: "404 Not Found",
+    405: "405 Method Not Allowed",
+    406: "406 Not Acceptable",
+    407: "407 Proxy Authentication Required",
+    408: "408 Request Timeout",
+    409: "409 Conflict",
+    410: "410 Gone",
+    411: "411 Length Required",
+    412: "412 Precondition Failed",
+    413: "413 Request Entity Too Large",
+    414: "414 Request-URI Too Long",
+    415: "415 Unsupported Media Type",
+    416: "416 Requested Range Not Satisfiable",
+    417: "417 Expectation Failed",
+    418: "418 I'm a teapot",
+    419: "419 Authentication Timeout",
+    422: "422 Unprocessable Entity",
+    423: "423 Locked",
+    424: "424 Failed Dependency",
+    426: "426 Upgrade Required",
+    428: "428 Precondition Required",
+    429: "429 Too Many Requests",
+    431: "431 Request Header Fields Too Large",
+    451: "451 Unavailable For Legal Reasons",
+    494: "494 Request Header Too Large",
+    # 5xx
+    500: "500 Internal Server Error",
+    501: "501 Not Implemented",
+    502: "502 Bad Gateway",
+    503: "503 Service Unavailable",
+    504: "504 Gateway Timeout",
+    505: "505 HTTP Version Not Supported",
+    506: "506 Variant Also Negotiates",
+    510: "510 Not Extended",
+    511: "511 Network Authentication Required",
+    # endfold
+}
+HTTP_STATUS_CLASS = {
+    1: "Informational",
+    2: "Success",
+    3: "Redirection",
+    4: "Client Error",
+    5: "Server Error",
+}
+
+
+def lazy(func):
+    """ Property computed on first access
+
+    Value is stored in `_{name}` attribute, and can be assigned.
+    """
+    name = "_%s" % func.__name__
+
+    def getter(self):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            value = func(self)
+            setattr(self, name, value)
+            return value
+
+    def setter(self, value):
+        setattr(self, name, value)
+
+    return property(getter, setter, doc=func.__doc__)
 
 
 # Core classes
 class Request(object):
-    """ Abstraction for an HTTP request """
-    def __init__(self, environ):
-        # Field: headers
+    """ Abstraction for an HTTP request
+
+    Fields are computed from WSGI environ on first access
+
+    environ - A WSGI environment
+    config - Application config. Used keys:
+             `request-max-size` - body size limit in bytes. Larger is 413 error
+             `request-spool-size` - body or uploaded file larger than it is
+                                    spooled to temp file
+             `request-part-max-size` - multipart part size limit in bytes
+             `json-decoder` - function to decode JSON body
+    """
+    __slots__ = (
+        "environ", "config",
+        "context",   # extension point: `x.request.context`
+        "__dict__",  # extension point: user assigned attributes
+        # lazy fields
+        "_headers", "_params", "_stream", "_body_file", "_data", "_json",
+        "_content_type", "_method", "_cookies", "_is_xhr", "_remote_addr",
+        "_scheme", "_host", "_domain", "_port", "_query", "_path",
+        "_path_query", "_host_url", "_path_url", "_url",
+    )
+
+    def __init__(self, environ, config=None):
+        self.environ = environ
+        self.config = config or {}
+
+    @lazy
+    def headers(self):
         """ Get all `HTTP_{HEADER_NAME}` environ keys """
-        self.headers = {}
-        for k, v in environ.iteritems():
+        headers = {}
+        for k, v in self.environ.iteritems():
             if k.startswith("HTTP_"):
                 name = k[5:].lower().replace("_", "-")
-                self.headers[name] = v
-
-        # Field: params
-        self.params = urlparse.parse_qs(environ["QUERY_STRING"], keep_blank_values=1)
-
-        content_type = environ.get("HTTP_CONTENT_TYPE", "") or environ.get("CONTENT_TYPE", "")
-        if "wsgi.input" in environ:
-            wsgi_input = environ["wsgi.input"]
-            if content_type.startswith("multipart/form-data"):
-                form = cgi.FieldStorage(fp=wsgi_input, environ=environ)
-                for k in form.keys():
-                    if isinstance(form[k], list):
-                        field = form[k][0]  # only first item
-                    else:
-                        field = form[k]
-
-                    if not field.filename:
-                        self.params[k] = field.value
-                    else:
-                        self.params[k] = field
-            else:
-                self.data = wsgi_input.read()
-                params = urlparse.parse_qs(self.data, keep_blank_values=1)
-                self.params.update(params)
-
-        # Field: method
-        self.method = environ["REQUEST_METHOD"].upper()
-
-        if self.method == "POST" and ":method" in self.params:
-            method = self.params.get(":method")
-            if isinstance(method, list):
-                self.method = method[0].upper()
-            else:
-                self.method = method.upper()
-
-        # Field: cookies
-        cookie = Cookie.SimpleCookie()
-        for c in environ.get("HTTP_COOKIE", "").split(";"):
+                headers[name] = v
+        return headers
+
+    @lazy
+    def params(self):
+        """ Query string and form body params """
+        params = urlparse.parse_qs(self.environ["QUERY_STRING"], keep_blank_values=1)
+
+        if "wsgi.input" in self.environ:
+            if self.content_type.startswith("multipart/form-data"):
+                _, options = cgi.parse_header(self.content_type)
+                parser = MultipartParser(self.stream, options.get("boundary", ""),
+                                         self.config.get("request-spool-size", 1024 * 1024),
+                                         self.config.get("request-part-max-size"))
+                params.update(parser.parse())
+            elif self.content_type.startswith("application/x-www-form-urlencoded"):
+                params.update(urlparse.parse_qs(self.data, keep_blank_values=1))
+
+        return params
+
+    @lazy
+    def stream(self):
+        """ File-like raw body. Read once, without buffering """
+        # missing or empty `Content-Length` is unknown length, 0 is empty body
+        length = None
+        if self.environ.get("CONTENT_LENGTH", "").strip():
             try:
-                cookie.load(c.strip())
-            except Cookie.CookieError:
-                info("Invalid cookie: %s" % c)
-        self.cookies = dict(cookie.items())
-
-        # Field: is_xhr
-        if environ.get("HTTP_X_REQUESTED_WITH", "") == "XMLHttpRequest":
-            self.is_xhr = True
-        else:
-            self.is_xhr = False
+                length = max(int(self.environ["CONTENT_LENGTH"]), 0)
+            except ValueError:
+                pass
 
-        # Field: remote_addr
-        self.remote_addr = environ.get("REMOTE_ADDR", None)
-        # endfold
+        return BodyStream(self.environ.get("wsgi.input"), length,
+                          self.config.get("request-max-size"))
 
-        " Example: http://foo.example.com:8000/path/page.html?x=y&z "
-        # Field: scheme     | http
-        self.scheme = environ.get("wsgi.url_scheme", "http")
+    @lazy
+    def body_file(self):
+        """ Seekable raw body. Spooled to temp file when large """
+        spool_size = self.config.get("request-spool-size", 1024 * 1024)
+        body_file = tempfile.SpooledTemporaryFile(max_size=spool_size)
 
-        # Field: host       | foo.example.com:8000
-        self.host = ensure_unicode(environ.get("HTTP_HOST", ""))
+        while True:
+            chunk = self.stream.read(BodyStream.CHUNK_SIZE)
+            if not chunk:
+                break
+            body_file.write(chunk)
+
+        body_file.seek(0)
+        return body_file
+
+    @lazy
+    def data(self):
+        """ Raw request body. Empty for `multipart/form-data` """
+        if "wsgi.input" not in self.environ:
+            return ""
+
+        if self.content_type.startswith("multipart/form-data"):
+            return ""  # parsed into params
+
+        data = self.body_file.read()
+        self.body_file.seek(0)
+        return data
+
+    @lazy
+    def json(self):
+        """ Decoded JSON body. None for empty body. Malformed is 400 error """
+        if not self.data:
+            return None
+
+        decoder = self.config.get("json-decoder") or json_loads
+        try:
+            return decoder(self.data)
+        except ValueError:
+            info("Malformed JSON body: %r" % self.data[:1000])
+            raise Response.Abort(400)
 
-        # Field: domain     | foo.example.com
-        self.domain = ensure_unicode(self.host.split(":", 1)[0])
+    @lazy
+    def content_type(self):
+        return (self.environ.get("HTTP_CONTENT_TYPE", "") or
+                self.environ.get("CONTENT_TYPE", ""))
 
-        # Field: port       | 8000
-        if ":" in self.host:
-            self.port = int(self.host.split(":")[1])
-        else:
-            self.port = 80
+    @lazy
+    def method(self):
+        method = self.environ["REQUEST_METHOD"].upper()
 
-        # Field: query      | x=y&z
-        self.query = ensure_unicode(environ["QUERY_STRING"])
+        if method == "POST" and ":method" in self.params:
+            method = self.params.get(":method")
+            if isinstance(method, list):
+                method = method[0]
+            method = method.upper()
 
-        # Field: path       | /path/page.html
-        self.path = ensure_unicode(environ["PATH_INFO"])
+        return method
 
-        # Field: path_query | /path/page.html?x=y&z
-        self.path_query = self.path
-        if self.query:
-            self.path_query += "?%s" % self.query
+    @lazy
+    def cookies(self):
+        return Cookies(self.environ.get("HTTP_COOKIE", ""))
 
-        # Field: host_url   | http://foo.example.com:8000/
-        self.host_url = u"%s://%s/" % (self.scheme, self.host)
+    @lazy
+    def is_xhr(self):
+        return self.environ.get("HTTP_X_REQUESTED_WITH", "") == "XMLHttpRequest"
 
-        # Field: path_url   | http://foo.example.com:8000/path/page.html
-        self.path_url = u"%s://%s%s" % (self.scheme, self.host, self.path)
+    @lazy
+    def remote_addr(self):
+        return self.environ.get("REMOTE_ADDR", None)
+    # endfold
 
-        # Field: url        | http://foo.example.com:8000/path/page.html?x=y&z
-        self.url = self.path_url
+    " Example: http://foo.example.com:8000/path/page.html?x=y&z "
+    # Field: scheme     | http
+    @lazy
+    def scheme(self):
+        return self.environ.get("wsgi.url_scheme", "http")
+
+    # Field: host       | foo.example.com:8000
+    @lazy
+    def host(self):
+        return ensure_unicode(self.environ.get("HTTP_HOST", ""))
+
+    # Field: domain     | foo.example.com
+    @lazy
+    def domain(self):
+        return ensure_unicode(self.host.split(":", 1)[0])
+
+    # Field: port       | 8000
+    @lazy
+    def port(self):
+        if ":" in self.host:
+            return int(self.host.split(":")[1])
+        return 80
+
+    # Field: query      | x=y&z
+    @lazy
+    def query(self):
+        return ensure_unicode(self.environ["QUERY_STRING"])
+
+    # Field: path       | /path/page.html
+    @lazy
+    def path(self):
+        return ensure_unicode(self.environ["PATH_INFO"])
+
+    # Field: path_query | /path/page.html?x=y&z
+    @lazy
+    def path_query(self):
         if self.query:
-            self.url += "?%s" % self.query
-        # endfold
+            return u"%s?%s" % (self.path, self.query)
+        return self.path
+
+    # Field: host_url   | http://foo.example.com:8000/
+    @lazy
+    def host_url(self):
+        return u"%s://%s/" % (self.scheme, self.host)
+
+    # Field: path_url   | http://foo.example.com:8000/path/page.html
+    @lazy
+    def path_url(self):
+        return u"%s://%s%s" % (self.scheme, self.host, self.path)
+
+    # Field: url        | http://foo.example.com:8000/path/page.html?x=y&z
+    @lazy
+    def url(self):
+        if self.query:
+            return u"%s?%s" % (self.path_url, self.query)
+        return self.path_url
+    # endfold
 
     def __getitem__(self, name):
         """ Usage: x.request[name] """
@@ -147,10 +391,21 @@ class Request(object):
 
 
 class Response(object):
-    """ Abstraction for an HTTP Response """
+    """ Abstraction for an HTTP Response
+
+    Body is kept as list of byte chunks, joined once when read. Streamed
+    iterable is sent after the chunks
+    """
+    __slots__ = (
+        "code", "chunks", "iterable", "headers", "gzip_path",
+        "__dict__",  # extension point: user assigned attributes
+    )
+
     def __init__(self, code=None):
         self.code = code or 200
-        self.body = ""
+        self.chunks = []
+        self.iterable = None
+        self.gzip_path = None
         self.headers = {
             "Content-Type": "text/plain; charset=utf-8",
         }
@@ -171,81 +426,72 @@ class Response(object):
         if kwargs.get("log") == "warning":
             warning(value.strip("\n"))
 
-        self.body += ensure_ascii("%s" % value)
+        self.chunks.append(ensure_ascii("%s" % value))
     # endfold
 
     @property
-    def status(self):
-        http_status = {
-            # 1xx
-            100: "100 Continue",
-            101: "101 Switching Protocols",
-            102: "102 Processing",
-            # 2xx
-            200: "200 OK",
-            201: "201 Created",
-            202: "202 Accepted",
-            203: "203 Non-Authoritative Information",
-            204: "204 No Content",
-            205: "205 Reset Content",
-            206: "206 Partial Content",
-            207: "207 Multi-Status",
-            208: "208 Already Reported",
-            226: "226 IM Used",
-            # 3xx
-            300: "300 Multiple Choices",
-            301: "301 Moved Permanently",
-            302: "302 Found",
-            303: "303 See Other",
-            304: "304 Not Modified",
-            305: "305 Use Proxy",
-            306: "306 Switch Proxy",
-            307: "307 Temporary Redirect",
-            308: "308 Permanent Redirect",
-            # 4xx
-            400: "400 Bad Request",
-            401: "401 Unauthorized",
-            402: "402 Payment Required",
-            403: "403 Forbidden",
-            404: "404 Not Found",
-            405: "405 Method Not Allowed",
-            406: "406 Not Acceptable",
-            407: "407 Proxy Authentication Required",
-            408: "408 Request Timeout",
-            409: "409 Conflict",
-            410: "410 Gone",
-            411: "411 Length Required",
-            412: "412 Precondition Failed",
-            413: "413 Request Entity Too Large",
-            414: "414 Request-URI Too Long",
-            415: "415 Unsupported Media Type",
-            416: "416 Requested Range Not Satisfiable",
-            417: "417 Expectation Failed",
-            418: "418 I'm a teapot",
-            419: "419 Authentication Timeout",
-            422: "422 Unprocessable Entity",
-            423: "423 Locked",
-            424: "424 Failed Dependency",
-            426: "426 Upgrade Required",
-            428: "428 Precondition Required",
-            429: "429 Too Many Requests",
-            431: "431 Request Header Fields Too Large",
-            451: "451 Unavailable For Legal Reasons",
-            494: "494 Request Header Too Large",
-            # 5xx
-            500: "500 Internal Server Error",
-            501: "501 Not Implemented",
-            502: "502 Bad Gateway",
-            503: "503 Service Unavailable",
-            504: "504 Gateway Timeout",
-            505: "505 HTTP Version Not Supported",
-            506: "506 Variant Also Negotiates",
-            510: "501 Not Extended",
-            511: "511 Network Authentication Required",
-            # endfold
-        }
+    def body(self):
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+
+        return self.chunks[0] if self.chunks else ""
+
+    @body.setter
+    def body(self, value):
+        # replaced stream is not sent. Example: file of `send_file`
+        if hasattr(self.iterable, "close"):
+            self.iterable.close()
+
+        self.chunks = [ensure_ascii(value)]
+        self.iterable = None
+
+    def stream(self, iterable):
+        """ Send chunks of iterable after written body, without buffering
+
+        Headers and session must be set before chunks are generated
+        """
+        self.iterable = iterable
+
+    def send_file(self, path, content_type=None):
+        """ Send file without reading it to memory
+
+        Sets `Content-Length`, `Last-Modified` and `ETag` headers. Sibling
+        `path.gz` is sent instead when client accepts gzip. Missing file is 404
+        """
+        try:
+            file_ = open(path, "rb")
+        except IOError:
+            raise self.Abort(404)
+
+        stat = os.fstat(file_.fileno())
+        if content_type is None:
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        self.headers["Content-Type"] = content_type
+        self.headers["Content-Length"] = str(stat.st_size)
+        self.headers["Last-Modified"] = http_date(stat.st_mtime)
+        self.headers["ETag"] = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+        self.gzip_path = path + ".gz" if os.path.isfile(path + ".gz") else None
+        self.chunks = []
+        self.iterable = file_
+        raise self.Sent
 
-        return http_status[self.code]
+    @property
+    def status(self):
+        try:
+            return HTTP_STATUS[self.code]
+        except KeyError:
+            return "%d %s" % (self.code, HTTP_STATUS_CLASS.get(self.code // 100, "Unknown"))
+
+    def add_header(self, name, value):
+        """ Add header, keeping previous values. Example: several `Set-Cookie` """
+        previous = self.headers.get(name)
+        if previous is None:
+            self.headers[name] = value
+        elif isinstance(previous, list):
+            previous.append(value)
+        else:
+            self.headers[name] = [previous, value]
     # endfold
 
     class Sent(Exception):
@@ -254,8 +500,19 @@ class Response(object):
     class Sent404(Exception):
         """ Response sent """
 
+    class Abort(Exception):
+        """ Response aborted with HTTP error code """
+        def __init__(self, code):
+            super(Response.Abort, self).__init__(code)
+            self.code = code
+
 
 class Handler(object):
+    __slots__ = (
+        "request", "response", "config", "session", "not_found", "exception",
+        "__dict__",  # extension point: user assigned attributes
+    )
+
     def __init__(self, request, response, config):
         config["context"] = config.get("context") or (lambda x: {})
 
@@ -287,44 +544,45 @@ class Handler(object):
         raise self.response.Sent
 
     def render_string(self, template, context=None, **kwargs):
-        loader = self.config.get("template-loader")
-        if not loader:
-            template_path = self.config.get("template-path") or "./templates"
-            loader = jinja2.FileSystemLoader(template_path)
+        env = jinja_environment(self.config)
+        final_context = self._render_context(context, kwargs)
+
+        # context functions can be jinja filter
+        env.filters.push(final_context)
+        try:
+            return env.get_template(template).render(final_context)
+        finally:
+            env.filters.pop()
 
-        # plugin containing templates
-        template_paths = []
-        for p in self.config.get(":plugins", []):
-            template_paths.append("%s/templates" % p.replace(".", "/"))
-        plugins_loader = jinja2.FileSystemLoader(template_paths)
+    def render_stream(self, template, context=None, **kwargs):
+        """ Send rendered template by chunks, split at `{% flush %}` tags
 
-        loader = jinja2.ChoiceLoader([loader, plugins_loader])
+        Headers and session must be set before. Example: `<head>` is sent
+        before rendering slow listing of body
+        """
+        env = jinja_environment(self.config)
+        final_context = self._render_context(context, kwargs)
+        final_context[":stream"] = True
 
-        env = jinja2.Environment(loader=loader,
-                                 line_comment_prefix="#:",
-                                 autoescape=self.config.get("jinja:autoescape", False),
-                                 extensions=["jinja2.ext.loopcontrols"])
+        # template errors are raised here, not in streamed body
+        env.filters.push(final_context)
+        try:
+            template = env.get_template(template)
+        finally:
+            env.filters.pop()
+
+        self.response.headers["Content-Type"] = "text/html; charset=UTF-8"
+        self.response.stream(template_chunks(env, template, final_context))
+        raise self.response.Sent
 
-        # default context
+    def _render_context(self, context, kwargs):
+        # request context, default context is environment globals
         final_context = {
-            "dir": dir,
-            "int": int,
-            "bool": bool,
-            "float": float,
-            "list": list,
-            "reversed": reversed,
-            "sorted": sorted,
-            "max": max,
-            "min": min,
-
-            "json": json,
-            "time": time,
             "now": datetime.now(),
 
             "request": self.request,
             "session": self.session,
             "config": self.config,
-            "environ": os.environ,
         }
         if kwargs.get("use_flash", True):
             final_context["flash"] = self.flash
@@ -341,13 +599,7 @@ class Handler(object):
         final_context.update(config_context)
         final_context.update(context or {})
         final_context.update(kwargs)
-
-        env.globals.update(final_context)
-
-        # context functions can be jinja filter
-        env.filters.update(final_context)
-
-        return env.get_template(template).render()
+        return final_context
 
     def redirect(self, url=None, permanent=False, code=302, delay=0):
         if not url:
@@ -366,6 +618,37 @@ class Handler(object):
 
         raise self.response.Sent
 
+    def not_modified(self, etag=None, last_modified=None, weak=False):
+        """ Send 304 when client cached copy is fresh. Use before rendering
+
+        etag - precomputed validator. Example: `entity.version`. Other than
+               int or str of ETag characters is hashed
+        last_modified - datetime (UTC) or HTTP date string. Example: `entity.updated`
+        weak - weak ETag
+        """
+        if etag is not None:
+            if isinstance(etag, (int, long)):
+                etag = str(etag)
+            elif not isinstance(etag, str) or not ETAG_RE.match(etag):
+                etag = hashlib.md5(repr(etag)).hexdigest()
+
+            etag = '%s"%s"' % ("W/" if weak else "", etag)
+            self.response.headers["ETag"] = etag
+
+        if isinstance(last_modified, datetime):
+            last_modified = http_date(last_modified)
+        if last_modified is not None:
+            self.response.headers["Last-Modified"] = last_modified
+
+        if self.request.environ["REQUEST_METHOD"].upper() not in ["GET", "HEAD"]:
+            return
+
+        if is_fresh(self.request.environ, etag, last_modified):
+            self.response.code = 304
+            self.response.body = ""
+            self.response.headers.pop("Content-Type", None)
+            raise self.response.Sent
+
     def abort(self, code, *args, **kwargs):
         self.response.code = code
         if code == 404:
@@ -381,11 +664,15 @@ class Handler(object):
 
         cookie = cookie_encode(self.config["session-key"], self.session)
         cookie_value = "session=%s; path=/; HttpOnly" % cookie
-        self.response.headers["Set-Cookie"] = cookie_value
 
-        cookie = Cookie.SimpleCookie()
-        cookie.load(cookie_value)
-        self.request.cookies = dict(cookie.items())
+        # session saved by before hook is replaced, other cookies are kept
+        previous = self.response.headers.pop("Set-Cookie", [])
+        for value in (previous if isinstance(previous, list) else [previous]):
+            if not value.startswith("session="):
+                self.response.add_header("Set-Cookie", value)
+        self.response.add_header("Set-Cookie", cookie_value)
+
+        self.request.cookies["session"] = cookie
     # endfold
 
     @property
@@ -407,10 +694,17 @@ class Application(object):
     """
     def __init__(self, routes=None, config=None):
         self.routes = []
+        self.special = {}  # special route -> [(priority, handler)]
+        self._router = None  # compiled routes
+        self._router_config = None
+        self._resolved = None  # resolved routes cache
+        self._router_lock = threading.Lock()
+        self.import_times = {}  # module -> import seconds
+
         for r in (routes or []):
             if len(r) == 2:
                 r = (0, r[0], r[1])
-            self.routes.append(r)
+            self._add_route(*r)
 
         self.config = config or {}  # none to dict
         self.config[":modules"] = [p[9:-3] for p in glob("handlers/[!_]*.py")]
@@ -426,15 +720,12 @@ class Application(object):
 
         Returns an iterable with the response to return the client
         """
-        request = Request(environ)
+        request = Request(environ, self.config)
         response = Response()
 
         try:
             # Before
-            for _, rule, before_handler in self.routes:
-                if rule != ":before":
-                    continue
-
+            for _, before_handler in self.special.get(":before", []):
                 x = Handler(request, response, self.config)
                 x.not_found = self.get_error_404()  # for x.abort()
 
@@ -444,14 +735,14 @@ class Application(object):
                 request = x.request
                 response = x.response
 
-                if response.body or response.code != 200:
+                if response.body or response.code != 200 or response.iterable:
                     raise self.DoneException
             # endfold
 
             x = Handler(request, response, self.config)
             x.not_found = self.get_error_404()  # for x.abort()
 
-            handler, args = self.get_handler(request.path, request.method)
+            handler, args, location = self.resolve(request.path, request.method)
             if handler:
                 # Handler
                 self._handler_call(handler, x, args)
@@ -460,41 +751,17 @@ class Application(object):
                 request = x.request
                 response = x.response
                 # endfold
-            else:
+            elif location:
                 # Unhandled alternative URL support
-                # redirect "/path/" -> "/path"
-                if request.path.endswith("/"):
-                    request_path = request.path[:-1]
-                    handler, _ = self.get_handler(request_path, request.method)
-                    if handler:
-                        # redirect to request_path
-                        location = request_path
-                        if request.query:
-                            location += "?%s" % request.query
-
-                        response.headers["Location"] = location
-                        response.code = 301  # permanent
-                        response.body = ""
-
-                        raise self.DoneException
-
-                # redirect "/path"  -> "/path/"
-                if not request.path.endswith("/"):
-                    request_path = request.path + "/"
-                    handler, _ = self.get_handler(request_path, request.method)
-                    if handler:
-                        # redirect to request_path
-                        location = request_path
-                        if request.query:
-                            location += "?%s" % request.query
-
-                        response.headers["Location"] = location
-                        response.code = 301  # permanent
-                        response.body = ""
-
-                        raise self.DoneException
-                # endfold
+                # redirect "/path/" -> "/path" or "/path" -> "/path/"
+                if request.query:
+                    location += "?%s" % request.query
 
+                response.headers["Location"] = location
+                response.code = 301  # permanent
+                response.body = ""
+                # endfold
+            else:
                 # Not found
                 not_found = self.get_error_404()
                 x.response.code = 404
@@ -506,6 +773,10 @@ class Application(object):
                 # endfold
         except self.DoneException:
             pass
+        except Response.Abort as ex:
+            # Aborted while routing. Example: too large request body
+            response.code = ex.code
+            response.body = "Error %s" % ex.code
         except Exception as ex:
             # Exception
             x = Handler(request, response, self.config)
@@ -517,8 +788,10 @@ class Application(object):
                        "---------------------------------------------------\n"
                        "%s\n"
                        "===================================================\n")
-            error(message % (x.request.method, x.request.url, str(request.params)[:3000]),
-                  exc_info=True)
+            # body is not parsed here, it can abort. Example: too large body
+            method = getattr(request, "_method", environ["REQUEST_METHOD"])
+            params = getattr(request, "_params", environ.get("QUERY_STRING", ""))
+            error(message % (method, x.request.url, str(params)[:3000]), exc_info=True)
 
             internal_error = self.get_error_500()
             try:
@@ -530,100 +803,357 @@ class Application(object):
             response = x.response
             # endfold
 
+        self._precompressed(request, response)
+        self._generate_etag(request, response)
+
+        # encoding headers are set before HEAD and 304 bodies are dropped
+        compressor = None
+        if self.config.get("compress"):
+            compressor = self._content_encoding(request, response)
+
+        self._validate_cache(request, response)
+        self._range(request, response)
+
         # special method support
-        if request.method == "HEAD":
+        if environ["REQUEST_METHOD"].upper() == "HEAD":
             response.body = ""
 
-        # response headers must be str not unicode
-        for key, value in response.headers.iteritems():
-            value = ensure_ascii(value)
-            value = urllib.quote(value, safe=string.printable)
-            response.headers[key] = value
-        start_response(response.status, response.headers.items())
+        if compressor:
+            self._compress(response, compressor)
+
+        start_response(response.status, header_list(response.headers))
+
+        if response.iterable is not None:
+            if isinstance(response.iterable, file) and not any(response.chunks):
+                file_wrapper = environ.get("wsgi.file_wrapper", FileWrapper)
+                return file_wrapper(response.iterable, BodyStream.CHUNK_SIZE)
+
+            return stream_body(response.chunks, response.iterable)
+
         return [response.body]
     # endfold
 
+    def _precompressed(self, request, response):
+        """ Send `.gz` sibling of `send_file` file by `Accept-Encoding` """
+        if response.gzip_path is None or response.iterable is None or response.code != 200:
+            return
+
+        add_vary(response.headers, "Accept-Encoding")
+
+        accepted = parse_accept_encoding(request.environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if accepted.get("gzip", accepted.get("*", 0)) <= 0:
+            return
+
+        try:
+            file_ = open(response.gzip_path, "rb")
+        except IOError:
+            return  # removed meanwhile
+
+        response.iterable.close()
+        response.iterable = file_
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Content-Length"] = str(os.fstat(file_.fileno()).st_size)
+
+        etag = response.headers["ETag"]
+        response.headers["ETag"] = '%s-gzip"' % etag[:-1]
+
+    def _generate_etag(self, request, response):
+        """ Generate ETag from body. Config `etag`: "strong" or "weak" """
+        if response.code != 200:
+            return
+
+        if request.environ["REQUEST_METHOD"].upper() not in ["GET", "HEAD"]:
+            return
+
+        etag = self.config.get("etag")
+        if etag and "ETag" not in response.headers and response.iterable is None:
+            digest = hashlib.md5(response.body).hexdigest()
+            response.headers["ETag"] = ('W/"%s"' if etag == "weak" else '"%s"') % digest
+
+    def _validate_cache(self, request, response):
+        """ Send 304 when client cached copy is fresh
+
+        Validators generated or set by handler (`ETag`, `Last-Modified`
+        headers) are checked
+        """
+        if response.code != 200:
+            return
+
+        if request.environ["REQUEST_METHOD"].upper() not in ["GET", "HEAD"]:
+            return
+
+        if is_fresh(request.environ, response.headers.get("ETag"),
+                    response.headers.get("Last-Modified")):
+            response.code = 304
+            response.body = ""
+            response.headers.pop("Content-Type", None)
+            response.headers.pop("Content-Length", None)
+            response.headers.pop("Content-Encoding", None)
+
+    def _range(self, request, response):
+        """ Send partial content by `Range` request header
+
+        Supports buffered body and streamed file (seekable) responses.
+        Single range is 206, multiple ranges are `multipart/byteranges`.
+        Unsatisfiable range is 416
+        """
+        if response.code != 200 or "Content-Encoding" in response.headers:
+            return  # encoded body is sent whole, without `Accept-Ranges`
+
+        file_ = response.iterable
+        if file_ is None:
+            size = len(response.body)
+        elif hasattr(file_, "seek") and hasattr(file_, "read") and not any(response.chunks):
+            base = file_.tell()
+            file_.seek(0, os.SEEK_END)
+            size = file_.tell() - base
+            file_.seek(base)
+        else:
+            return  # unknown size
+
+        response.headers["Accept-Ranges"] = "bytes"
+
+        header = request.environ.get("HTTP_RANGE")
+        if not header or request.environ["REQUEST_METHOD"].upper() != "GET":
+            return
+
+        # If-Range: send whole body when validator is changed
+        if_range = request.environ.get("HTTP_IF_RANGE", "").strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            if if_range.startswith("W/") or if_range != response.headers.get("ETag"):
+                return
+        elif if_range:
+            last_modified = response.headers.get("Last-Modified")
+            if not last_modified or parse_http_date(if_range) != parse_http_date(last_modified):
+                return
+
+        ranges = parse_range(header, size)
+        if ranges is None:
+            return  # invalid header is ignored
+
+        if not ranges:
+            response.code = 416
+            response.body = ""
+            response.headers["Content-Range"] = "bytes */%d" % size
+            return
+
+        def read(start, stop):
+            if file_ is None:
+                return [response.body[start:stop]]
+            return read_file(file_, base + start, base + stop)
+
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            response.code = 206
+            response.headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, size)
+            response.headers["Content-Length"] = str(stop - start)
+            chunks = read(start, stop)
+        else:
+            boundary = os.urandom(12).encode("hex")
+            content_type = response.headers.get("Content-Type", "application/octet-stream")
+
+            parts = []
+            for start, stop in ranges:
+                head = ("--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" %
+                        (boundary, content_type, start, stop - 1, size))
+                parts.append((head, read, start, stop))
+            closing = "--%s--\r\n" % boundary
+
+            length = sum(len(head) + stop - start + 2 for head, _, start, stop in parts)
+            length += len(closing)
+            if length >= size:
+                return  # whole body is smaller
+
+            response.code = 206
+            response.headers["Content-Type"] = "multipart/byteranges; boundary=%s" % boundary
+            response.headers["Content-Length"] = str(length)
+            chunks = byteranges(parts, closing)
+
+        if file_ is None:
+            response.body = "".join(chunks)
+        else:
+            response.iterable = closing_iterator(chunks, file_)
+
+    def _content_encoding(self, request, response):
+        """ Choose encoding by `Accept-Encoding` request header
+
+        Sets `Content-Encoding`, `Vary` and ETag suffix. Returns compressor
+        for `_compress` or none
+
+        Config:
+            `compress` - enable compression
+            `compress-min-size` - smaller body is not compressed
+            `compress-types` - content type prefixes to compress
+            `compress-level` - zlib compression level
+        """
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        if not content_type.startswith(tuple(self.config.get("compress-types", COMPRESS_TYPES))):
+            return
+
+        if response.code < 200 or response.code in [204, 206, 304, 416]:
+            return
+
+        if "Content-Encoding" in response.headers:
+            return  # already encoded
+
+        if response.iterable is None:
+            if not response.body:
+                return  # nothing to compress
+
+            if len(response.body) < self.config.get("compress-min-size", 1024):
+                return
+
+        # response differs by `Accept-Encoding`
+        add_vary(response.headers, "Accept-Encoding")
+
+        accepted = parse_accept_encoding(request.environ.get("HTTP_ACCEPT_ENCODING", ""))
+        for encoding, wbits in [("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)]:
+            if accepted.get(encoding, accepted.get("*", 0)) > 0:
+                break
+        else:
+            return  # not accepted
+
+        response.headers["Content-Encoding"] = encoding
+        response.headers.pop("Content-Length", None)
+
+        # strong ETag differs by encoding
+        etag = response.headers.get("ETag", "")
+        if etag.endswith('"') and not etag.startswith("W/"):
+            response.headers["ETag"] = '%s-%s"' % (etag[:-1], encoding)
+
+        level = self.config.get("compress-level", 6)
+        return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def _compress(self, response, compressor):
+        """ Compress response body. Empty body is kept. Example: HEAD request """
+        if response.iterable is None:
+            if response.body:
+                response.body = compressor.compress(response.body) + compressor.flush()
+        else:
+            iterable = response.iterable
+            if isinstance(iterable, file):
+                iterable = FileWrapper(iterable)  # by blocks, not lines
+
+            response.iterable = compress_stream(compressor, response.chunks, iterable)
+            response.chunks = []
+
     def get_handler(self, request_path, request_method):
         """ Returns (handler, args) or (none, none) """
-        for _, rule, handler in self.routes:
-            rule = ensure_unicode(rule)
-            rule = rule.replace("<int>", "(int:\\d+)")
-            rule = rule.replace("<string>", "([^/]+)")
-            shortcuts = self.config.get("route-shortcut", {})
-
-            for k, v in sorted(shortcuts.items(), key=lambda x: - len(x[1])):
-                rule = rule.replace(k, v)
-
-            " route method. route rule: /path/to#method "
-            if re.search("#%s$" % METHOD_RE, rule):
-                rule, method = rule.rsplit("#", 1)
-                method = method.upper()
+        return self.compile_routes().match(request_path, request_method)
+
+    def resolve(self, request_path, request_method):
+        """ Returns (handler, args, none), (none, none, location) or (none, none, none)
+
+        Location is alternative URL with or without trailing slash.
+        Results are kept in bounded LRU cache (config: `route-cache-size`)
+        """
+        router = self.compile_routes()
+        resolved_cache = self._resolved
+
+        key = (request_path, request_method)
+        resolved = resolved_cache.get(key)
+        if resolved:
+            return resolved
+
+        handler, args = router.match(request_path, request_method)
+        location = None
+
+        if not handler:
+            if request_path.endswith("/"):
+                alternative = request_path[:-1]
             else:
-                method = "GET"  # default method
+                alternative = request_path + "/"
 
-            " match method "
-            method_choices = ["GET", "HEAD"] if method == "GET" else [method]
-            if request_method not in method_choices:
-                # method not allowed
-                continue
+            if router.match(alternative, request_method)[0]:
+                location = alternative
 
-            " match url "
-            # has any groups
-            re_groups = re.compile("""
-              \\(        # `(` character. Marks group start
-              (
-                [^\\)]+  # Until ")" character
-              )
-              \\)        # `)` character. Marks group ends
-            """, re.VERBOSE)
-
-            convert_rules = []
-            for group in re.findall(re_groups, rule):
-                if group.startswith("int:"):
-                    convert_rules.append(lambda x: int(x))
-                else:
-                    convert_rules.append(lambda x: x)
-
-            rule_simple = re.sub("\\([a-z]+\\:", "(", rule)
-            if not re.search("^%s$" % rule_simple, request_path):
-                continue
+        resolved = (handler, args, location)
+        resolved_cache.set(key, resolved)
 
-            args = list(re.search("^%s$" % rule_simple, request_path).groups())
-            for i, convert in enumerate(convert_rules):
-                args[i] = convert(args[i])
+        return resolved
 
-            return handler, args
+    def freeze(self):
+        """ Order routes and build compiled router once
 
-        return None, None
+        Routes registered later are ordered on next freeze. Called on first
+        request, or explicitly after bulk registration:
 
-    def get_error_404(self):
-        def _not_found(x):
-            x.response.code = 404
-            x.response.body = "Error 404"
+        >>> for rule, handler in many_routes:
+        >>>     app.route(rule, handler)
+        >>> app.freeze()
+        """
+        self.compile_routes()
 
-        for _, rule, handler in self.routes:
-            if rule == ":error-404":
-                return handler
+    def compile_routes(self):
+        """ Returns router of compiled routes
+
+        Rebuilt after route, `route-shortcut` or `route-engine` change
+        """
+        shortcuts = self.config.get("route-shortcut", {})
+        engine = self.config.get("route-engine", "trie")
+
+        router = self._router
+        if router is not None and self._router_config == (engine, shortcuts):
+            return router
+
+        with self._router_lock:
+            if self._router is not None and self._router_config == (engine, shortcuts):
+                return self._router
 
-        return _not_found
+            # stable: by priority, then registration order
+            self.routes.sort(key=lambda r: r[0])
+
+            table = []
+            for _, rule, handler in self.routes:
+                if rule.startswith(":"):
+                    continue  # special route
+
+                table.append(compile_rule(rule, shortcuts) + (handler,))
+
+            # cache is published before router, lock-free readers use both
+            router = ROUTERS[engine](table)
+            self._resolved = LRUCache(self.config.get("route-cache-size", 1000))
+            self._router_config = (engine, dict(shortcuts))
+            self._router = router
+
+        return router
+
+    def get_error_404(self):
+        handlers = self.special.get(":error-404")
+        if handlers:
+            return handlers[0][1]
+
+        return self._not_found
 
     def get_error_500(self):
-        def _internal_error(x):
-            lines = traceback.format_exception(*sys.exc_info())
+        handlers = self.special.get(":error-500")
+        if handlers:
+            return handlers[0][1]
 
-            x.response.headers["Content-Type"] = "text/plain;error"
-            x.response.body = "".join(lines)
+        return self._internal_error
 
-        for _, rule, handler in self.routes:
-            if rule == ":error-500":
-                return handler
+    @staticmethod
+    def _not_found(x):
+        x.response.code = 404
+        x.response.body = "Error 404"
+
+    @staticmethod
+    def _internal_error(x):
+        lines = traceback.format_exception(*sys.exc_info())
 
-        return _internal_error
+        x.response.headers["Content-Type"] = "text/plain;error"
+        x.response.body = "".join(lines)
     # endfold
 
     def _handler_call(self, handler, x, args):
         try:
-            handler(x, *args)
+            result = handler(x, *args)
+
+            if isinstance(result, types.GeneratorType):
+                # Generator handler. Run until first chunk, so headers and
+                # session set before it are sent
+                x.response.write(next(result, ""))
+                x.response.stream(result)
         except x.response.Sent:
             pass
         except x.response.Sent404:
@@ -633,6 +1163,11 @@ class Application(object):
                 not_found(x)
             except x.response.Sent:
                 pass
+        except x.response.Abort as ex:
+            try:
+                x.abort(ex.code)
+            except x.response.Sent:
+                pass
 
     def route(self, route, handler_path=None, priority=1):
         """ Initialize and add route
@@ -647,15 +1182,14 @@ class Application(object):
             Usage 2. Includer method
             ________________________
 
-        >>> route("/", "path.handler")
+        >>> route("/", "path.handler:function")
         """
         # Usage 1. Decorator
         # `route("/")(handler)` <=> `func(handler)`
         # need to return `func`
         if handler_path is None:
             def func(handler):
-                self.routes += [(priority, route, handler)]
-                self.routes = sorted(self.routes)
+                self._add_route(priority, route, handler)
 
                 return handler
             return func
@@ -673,8 +1207,10 @@ class Application(object):
             else:
                 importable = "%s.handlers" % module_path
 
-            module = importlib.import_module(importable)
-            handler = getattr(module, name)
+            # imported on first match. Or now by `route-preload` config
+            handler = LazyHandler(importable, name, self.import_times)
+            if self.config.get("route-preload"):
+                handler.load()
             # endfold
         else:
             # Usage 2. Includer (function)
@@ -682,12 +1218,38 @@ class Application(object):
             handler = handler_path
             # endfold
 
-        self.routes += [(priority, route, handler)]
-        self.routes = sorted(self.routes)
+        self._add_route(priority, route, handler)
 
         return handler
         # endfold
 
+    def _add_route(self, priority, route, handler):
+        # ordered once by `freeze`
+        self.routes.append((priority, route, handler))
+
+        if route.startswith(":"):
+            # special route. Example: `:before`, `:error-404`
+            handlers = self.special.setdefault(route, [])
+            position = bisect_right([p for p, _ in handlers], priority)
+            handlers.insert(position, (priority, handler))
+        else:
+            self._router = None
+
+    def preload(self):
+        """ Import all lazy route handlers. Useful in warmup request
+
+        >>> @route("/_ah/warmup")
+        >>> def warmup(x):
+        >>>     app.preload()
+
+        Returns import seconds of each module
+        """
+        for _, _, handler in self.routes:
+            if isinstance(handler, LazyHandler):
+                handler.load()
+
+        return self.import_times
+
     def include(self, controller):
         """ Usage:
 
@@ -702,11 +1264,561 @@ class Application(object):
 # Helpers
 class Session(dict):
     """ Customized `dict` data structure for session """
+    __slots__ = ("initial",)
+
     def __init__(self, *args, **kwargs):
         super(Session, self).__init__(*args, **kwargs)
         self.initial = self.copy()
 
 
+class LazyHandler(object):
+    """ Route handler imported on first call
+
+    importable - module path. Example: `handlers.home`
+    name - handler function name in the module
+    import_times - dict to report module import seconds
+    """
+    def __init__(self, importable, name, import_times=None):
+        self.importable = importable
+        self.name = name
+        self.import_times = import_times if import_times is not None else {}
+        self.handler = None
+
+    def __call__(self, x, *args):
+        return (self.handler or self.load())(x, *args)
+
+    def __repr__(self):
+        return "<LazyHandler %s:%s>" % (self.importable, self.name)
+
+    def load(self):
+        """ Returns imported handler function """
+        if self.handler:
+            return self.handler
+
+        if self.importable in sys.modules:
+            module = sys.modules[self.importable]
+        else:
+            started = time.time()
+            module = importlib.import_module(self.importable)
+            self.import_times[self.importable] = time.time() - started
+
+            info("Imported %s in %.1fms" % (self.importable,
+                                            self.import_times[self.importable] * 1000))
+
+        self.handler = getattr(module, self.name)
+        return self.handler
+
+
+class BodyStream(object):
+    """ File-like reader of request body
+
+    wsgi_input - `wsgi.input` stream
+    length - `Content-Length` of the body. Read until end if none
+    max_size - body size limit. Larger body aborts with 413 error
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, wsgi_input, length=None, max_size=None):
+        if max_size is not None and length is not None and length > max_size:
+            raise Response.Abort(413)
+
+        self.input = wsgi_input
+        self.length = length
+        self.max_size = max_size
+        self.position = 0
+
+    def read(self, size=-1):
+        return self._read(self.input.read, size)
+
+    def readline(self, size=-1):
+        return self._read(self.input.readline, size)
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def _read(self, reader, size):
+        if self.input is None:
+            return ""
+
+        " bytes allowed to read "
+        remaining = None
+        if self.length is not None:
+            remaining = self.length - self.position
+        elif self.max_size is not None:
+            remaining = self.max_size - self.position + 1  # one more to detect
+
+        if remaining is not None and (size is None or size < 0 or size > remaining):
+            size = remaining
+
+        if size is None or size < 0:
+            chunk = reader()
+        else:
+            chunk = reader(size) if size else ""
+
+        self.position += len(chunk)
+        if self.max_size is not None and self.position > self.max_size:
+            raise Response.Abort(413)
+
+        return chunk
+
+
+class MultipartParser(object):
+    """ Streaming `multipart/form-data` parser
+
+    stream - file-like request body
+    boundary - multipart boundary from `Content-Type`
+    spool_size - uploaded file larger than it is spooled to temp file
+    part_max_size - part size limit. Larger part aborts with 413 error
+    """
+    HEADERS_MAX_SIZE = 16 * 1024
+
+    def __init__(self, stream, boundary, spool_size=1024 * 1024, part_max_size=None):
+        if not boundary:
+            raise Response.Abort(400)
+
+        self.stream = stream
+        self.separator = "\r\n--%s" % boundary.strip('"')
+        self.spool_size = spool_size
+        self.part_max_size = part_max_size
+
+    def parse(self):
+        """ Returns params. Field name -> list of values or `Upload` """
+        params = {}
+
+        " preamble. prepend line break, so first boundary is same as others "
+        buf, found = self._read_until("\r\n", self.separator, lambda data: None)
+        if not found:
+            raise Response.Abort(400)
+
+        while True:
+            buf = self._fill(buf, 2)
+            if buf.startswith("--"):
+                break  # closing boundary
+
+            # Part headers
+            headers = []
+            buf, found = self._read_until(buf, "\r\n\r\n", headers.append,
+                                          self.HEADERS_MAX_SIZE)
+            if not found:
+                raise Response.Abort(400)
+
+            disposition, content_type = "", None
+            for line in "".join(headers).strip().split("\r\n"):
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    if name.strip().lower() == "content-disposition":
+                        disposition = value
+                    if name.strip().lower() == "content-type":
+                        content_type = value.strip()
+
+            _, options = cgi.parse_header(disposition)
+            name = options.get("name")
+            # endfold
+
+            # Part body. Empty file input (filename="") is empty string
+            if options.get("filename"):
+                value = Upload(name, options["filename"], content_type,
+                               tempfile.SpooledTemporaryFile(max_size=self.spool_size))
+                buf, found = self._read_until(buf, self.separator, value.file.write,
+                                              self.part_max_size)
+                value.file.seek(0)
+            else:
+                chunks = []
+                buf, found = self._read_until(buf, self.separator, chunks.append,
+                                              self.part_max_size)
+                value = "".join(chunks)
+
+            if not found:
+                raise Response.Abort(400)  # truncated body
+            # endfold
+
+            if name is not None:
+                params.setdefault(name, []).append(value)
+
+        return params
+
+    def _fill(self, buf, size):
+        """ Read until buffer has at least `size` bytes or body ends """
+        while len(buf) < size:
+            chunk = self.stream.read(BodyStream.CHUNK_SIZE)
+            if not chunk:
+                break
+            buf += chunk
+        return buf
+
+    def _read_until(self, buf, marker, write, max_size=None):
+        """ Write data before marker. Returns (rest of buffer, found) """
+        written = 0
+        keep = len(marker) - 1  # marker may be split between chunks
+
+        while True:
+            index = buf.find(marker)
+            if index >= 0:
+                data, buf = buf[:index], buf[index + len(marker):]
+            elif len(buf) > keep:
+                data, buf = buf[:-keep], buf[-keep:]
+            else:
+                data = ""
+
+            written += len(data)
+            if max_size is not None and written > max_size:
+                raise Response.Abort(413)
+
+            if data:
+                write(data)
+
+            if index >= 0:
+                return buf, True
+
+            chunk = self.stream.read(BodyStream.CHUNK_SIZE)
+            if not chunk:
+                return buf, False
+            buf += chunk
+
+
+class Upload(object):
+    """ Uploaded file of multipart request
+
+    name - form field name
+    filename - client side file name
+    type - content type of the file
+    file - file-like content
+    """
+    def __init__(self, name, filename, type_, file_):
+        self.name = name
+        self.filename = filename
+        self.type = type_
+        self.file = file_
+
+    def __repr__(self):
+        return "Upload(%r, %r)" % (self.name, self.filename)
+
+    @property
+    def value(self):
+        """ Whole file content """
+        self.file.seek(0)
+        value = self.file.read()
+        self.file.seek(0)
+        return value
+
+
+class Cookies(MutableMapping):
+    """ Lazy parsed `Cookie` header
+
+    Values are `Cookie.Morsel`. Each cookie is decoded on first access
+    """
+    def __init__(self, header=""):
+        self.header = header
+        self.morsels = {}
+        self._raw = None  # name -> coded value
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            self._raw = {}
+            for c in self.header.split(";"):
+                name, _, value = c.partition("=")
+                name = name.strip()
+                if name and not name.startswith("$"):
+                    self._raw[name] = value.strip()
+        return self._raw
+
+    def __getitem__(self, name):
+        if name not in self.morsels:
+            if name not in self.raw:
+                raise KeyError(name)
+
+            self[name] = self.raw.pop(name)
+
+        return self.morsels[name]
+
+    def __setitem__(self, name, value):
+        if not isinstance(value, Cookie.Morsel):
+            morsel = Cookie.Morsel()
+            try:
+                morsel.set(name, Cookie._unquote(value), value)
+            except Cookie.CookieError:
+                info("Invalid cookie: %s=%s" % (name, value))
+                return
+            value = morsel
+
+        self.raw.pop(name, None)
+        self.morsels[name] = value
+
+    def __delitem__(self, name):
+        if name in self.raw:
+            del self.raw[name]
+        else:
+            del self.morsels[name]
+
+    def __iter__(self):
+        for name in self.raw.keys():
+            self.get(name)  # decode to drop invalid
+        return iter(self.morsels)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def jinja_environment(config):
+    """ Jinja environment of app config, reused until template config changes
+
+    Config: `template-path`, `template-loader`, `:plugins`, `jinja:autoescape`,
+    `template-compiled` - folder by `python natrix.py compile-templates`,
+    `jinja:bytecode-cache` - share compiled templates by memcache,
+    `jinja:bytecode-cache-dir` - local file cache checked before memcache,
+    `jinja:fragment-cache-size` - in-process entries of `{% cache %}` tag
+    """
+    key = (
+        config.get("template-path"),
+        config.get("template-loader"),
+        config.get("template-compiled"),
+        tuple(config.get(":plugins", [])),
+        config.get("jinja:autoescape", False),
+        config.get("jinja:bytecode-cache", False),
+        config.get("jinja:bytecode-cache-dir"),
+        config.get("jinja:fragment-cache-size", 1000),
+    )
+    cached = config.get(":jinja")
+    if cached and cached[0] == key:
+        return cached[1]
+
+    loader = config.get("template-loader")
+    if not loader:
+        template_path = config.get("template-path") or "./templates"
+        loader = jinja2.FileSystemLoader(template_path)
+
+    # plugin containing templates
+    template_paths = []
+    for p in config.get(":plugins", []):
+        template_paths.append("%s/templates" % p.replace(".", "/"))
+    plugins_loader = jinja2.FileSystemLoader(template_paths)
+
+    loader = jinja2.ChoiceLoader([loader, plugins_loader])
+
+    # precompiled templates are never parsed
+    if config.get("template-compiled"):
+        loader = jinja2.ModuleLoader(config["template-compiled"])
+
+    bytecode_cache = None
+    if config.get("jinja:bytecode-cache"):
+        # compiled code differs by autoescape
+        prefix = "jinja:%s:" % ("autoescape" if config.get("jinja:autoescape") else "")
+        bytecode_cache = JinjaBytecodeCache(prefix, config.get("jinja:bytecode-cache-dir"))
+
+    env = jinja2.Environment(loader=loader,
+                             line_comment_prefix="#:",
+                             autoescape=config.get("jinja:autoescape", False),
+                             extensions=[
+                                 "jinja2.ext.loopcontrols",
+                                 FragmentCacheExtension,
+                                 FlushExtension,
+                             ],
+                             bytecode_cache=bytecode_cache)
+    env.fragment_cache = LRUCache(config.get("jinja:fragment-cache-size", 1000))
+    env.globals.update(JINJA_GLOBALS)
+    env.filters = JinjaFilters(env.filters)
+    env.filters.update(JINJA_GLOBALS)
+
+    config[":jinja"] = (key, env)
+    return env
+
+
+class JinjaFilters(dict):
+    """ Jinja filters with per render overlay of context functions
+
+    Compiled templates look filters up on each render, so the overlay
+    pushed by the rendering thread is used. On compile, overlay filters
+    are stubs, not to be evaluated as constant by jinja optimizer
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(JinjaFilters, self).__init__(*args, **kwargs)
+        self.local = threading.local()
+
+    def push(self, overlay):
+        if not hasattr(self.local, "overlays"):
+            self.local.overlays = []
+        self.local.overlays.append(overlay)
+
+    def pop(self):
+        self.local.overlays.pop()
+
+    def __getitem__(self, name):
+        overlays = getattr(self.local, "overlays", None)
+        if overlays and name in overlays[-1]:
+            return overlays[-1][name]
+        return super(JinjaFilters, self).__getitem__(name)
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, name, default=None):
+        overlays = getattr(self.local, "overlays", None)
+        if overlays and name in overlays[-1]:
+            return self.stub(overlays[-1][name])
+        return super(JinjaFilters, self).get(name, default)
+
+    @staticmethod
+    def stub(func):
+        def render_only(*args, **kwargs):
+            raise RuntimeError("Filter is known on render only")
+        # endfold
+
+        for flag in ["contextfilter", "evalcontextfilter", "environmentfilter"]:
+            if getattr(func, flag, False) is True:
+                setattr(render_only, flag, True)
+        return render_only
+
+
+class JinjaBytecodeCache(jinja2.BytecodeCache):
+    """ Compiled templates in memcache, shared by all instances
+
+    Memcache key contains hash of template source, so changed template is
+    compiled again. Optional local file cache is checked first
+    """
+
+    def __init__(self, prefix="jinja:", directory=None):
+        self.prefix = prefix
+        self.files = jinja2.FileSystemBytecodeCache(directory) if directory else None
+
+    def load_bytecode(self, bucket):
+        if self.files is not None:
+            self.files.load_bytecode(bucket)
+            if bucket.code is not None:
+                return
+
+        value = memcache.get(self.memcache_key(bucket))
+        if value is None:
+            return
+
+        bucket.bytecode_from_string(value)
+        if bucket.code is not None and self.files is not None:
+            self.files.dump_bytecode(bucket)
+
+    def dump_bytecode(self, bucket):
+        if self.files is not None:
+            self.files.dump_bytecode(bucket)
+
+        memcache.set(self.memcache_key(bucket), bucket.bytecode_to_string())
+
+    def memcache_key(self, bucket):
+        return "%s%s:%s" % (self.prefix, bucket.key, bucket.checksum)
+
+
+class FragmentCacheExtension(jinja2.ext.Extension):
+    """ Cache rendered block in memcache, with in-process LRU in front
+
+    {% cache "sidebar", 300, request.path %}...{% endcache %}
+    Arguments: key, time to live in seconds (default: 1 hour), values to
+    vary by. Key is scoped by template name and app version
+    """
+    tags = {"cache"}
+    default_ttl = 3600
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.__dict__.setdefault("fragment_cache", LRUCache(1000))
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        if len(args) == 1:
+            args.append(jinja2.nodes.Const(None))
+
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        call = self.call_method("_cache", [
+            jinja2.nodes.Const(parser.name), args[0], args[1], jinja2.nodes.List(args[2:]),
+        ])
+        return jinja2.nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache(self, template, key, ttl, vary, caller):
+        parts = [os.environ.get("CURRENT_VERSION_ID", ""), template, key] + vary
+        parts = [ensure_unicode("%s" % i) for i in parts]
+        key = "fragment:%s" % hashlib.md5(ensure_ascii(u"\x00".join(parts))).hexdigest()
+        ttl = ttl or self.default_ttl
+        now = time.time()
+
+        # in-process, then memcache
+        cached = self.environment.fragment_cache.get(key)
+        if cached is None or cached[0] < now:
+            cached = memcache.get(key)
+            if cached is not None:
+                self.environment.fragment_cache.set(key, cached)
+
+        if cached is not None and cached[0] >= now:
+            return cached[1]
+
+        # value type (Markup when autoescape) is kept. Flush is not cached
+        value = caller()
+        cached = (now + ttl, value.replace(FlushExtension.marker, u""))
+        self.environment.fragment_cache.set(key, cached)
+        memcache.set(key, cached, time=ttl)
+        return value
+
+
+class FlushExtension(jinja2.ext.Extension):
+    """ `{% flush %}` sends rendered part of `render_stream` to client
+
+    Not allowed in `filter` and `set` blocks, their content is not output
+    as is. Marker has no letters, not to be changed by filters like `upper`
+    """
+    tags = {"flush"}
+    marker = jinja2.Markup(u"\x00\x1a\x00")
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        for tag in parser._tag_stack:
+            if tag in ["filter", "set"]:
+                parser.fail("flush is not allowed in %s block" % tag, lineno)
+
+        call = self.call_method("_flush", [jinja2.nodes.ContextReference()])
+        return jinja2.nodes.Output([call]).set_lineno(lineno)
+
+    def _flush(self, context):
+        # not streamed, nothing to output
+        return self.marker if context.get(":stream") else u""
+
+
+def template_chunks(env, template, context):
+    """ Generate template by chunks, split at `{% flush %}` markers """
+    events = template.generate(context)
+    buffered = []
+    while events is not None:
+        # context functions can be jinja filter, also between chunks
+        env.filters.push(context)
+        try:
+            for event in events:
+                if FlushExtension.marker not in event:
+                    buffered.append(event)
+                    continue
+
+                # marker can be inside buffered output. Example: macro
+                parts = event.split(FlushExtension.marker)
+                chunks = [u"".join(buffered + parts[:1])] + parts[1:-1]
+                buffered = parts[-1:]
+                break
+            else:
+                chunks = [u"".join(buffered)]
+                events = None
+        finally:
+            env.filters.pop()
+
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+
+
 def cookie_encode(key, value, timestamp=None):
     """ Secure cookie serialize
 
@@ -780,6 +1892,482 @@ def cookie_signature(key, value, timestamp):
     return signature.hexdigest()
 
 
+def compile_rule(rule, shortcuts=None):
+    """ Compile route rule
+
+    rule - route rule. Example: `/path/<int>#post`
+    shortcuts - `route-shortcut` config
+
+    Returns (methods, pattern, converters)
+    """
+    rule = ensure_unicode(rule)
+    rule = rule.replace("<int>", PLACEHOLDER_INT)
+    rule = rule.replace("<string>", PLACEHOLDER_STRING)
+
+    for k, v in sorted((shortcuts or {}).items(), key=lambda x: - len(x[1])):
+        rule = rule.replace(k, v)
+
+    " route method. route rule: /path/to#method "
+    if re.search("#%s$" % METHOD_RE, rule):
+        rule, method = rule.rsplit("#", 1)
+        method = method.upper()
+    else:
+        method = "GET"  # default method
+
+    methods = frozenset(["GET", "HEAD"] if method == "GET" else [method])
+
+    " group converters. `None` keeps matched value as is "
+    converters = []
+    for group in GROUP_RE.findall(rule):
+        converters.append(int if group.startswith("int:") else None)
+
+    " path segments. `None` if rule has free-form groups "
+    placeholders = PLACEHOLDER_RE.findall(rule)
+    segments = []
+    for segment in PLACEHOLDER_RE.sub("\x00", rule).split("/"):
+        if segment == "\x00":
+            segment = placeholders.pop(0)
+        elif not LITERAL_RE.match(segment):
+            segments = None
+            break
+        segments.append(segment)
+
+    pattern = re.compile("^%s$" % re.sub("\\([a-z]+\\:", "(", rule))
+
+    return methods, pattern, converters, segments
+
+
+class RegexRouter(object):
+    """ Matches compiled routes one by one in priority order """
+    def __init__(self, table):
+        self.table = table
+
+    def match(self, request_path, request_method):
+        """ Returns (handler, args) or (none, none) """
+        for methods, pattern, converters, _, handler in self.table:
+            if request_method not in methods:
+                continue
+
+            match = pattern.match(request_path)
+            if match:
+                return handler, convert_args(match.groups(), converters)
+
+        return None, None
+
+
+class TrieRouter(object):
+    """ Segment trie for literal, `<int>` and `<string>` routes
+
+    Routes with free-form groups are matched by regex. A regex route wins
+    only when it is prior to the trie match.
+    """
+    def __init__(self, table):
+        self.trees = {}     # method -> node
+        self.fallback = {}  # method -> [(index, pattern, converters, handler)]
+
+        for index, (methods, pattern, converters, segments, handler) in enumerate(table):
+            for method in methods:
+                if segments is None:
+                    item = (index, pattern, converters, handler)
+                    self.fallback.setdefault(method, []).append(item)
+                    continue
+
+                " node: [literal children, int child, string child, route] "
+                node = self.trees.setdefault(method, [{}, None, None, None])
+                for segment in segments:
+                    if segment == PLACEHOLDER_INT:
+                        node[1] = node[1] or [{}, None, None, None]
+                        node = node[1]
+                    elif segment == PLACEHOLDER_STRING:
+                        node[2] = node[2] or [{}, None, None, None]
+                        node = node[2]
+                    else:
+                        node = node[0].setdefault(segment, [{}, None, None, None])
+
+                # first registered route of same rule wins
+                node[3] = node[3] or (index, converters, handler)
+
+    def match(self, request_path, request_method):
+        """ Returns (handler, args) or (none, none) """
+        found = None
+        if request_method in self.trees:
+            found = self._search(self.trees[request_method], request_path.split("/"), 0, [])
+
+        for index, pattern, converters, handler in self.fallback.get(request_method, []):
+            if found and found[0] < index:
+                break
+
+            match = pattern.match(request_path)
+            if match:
+                return handler, convert_args(match.groups(), converters)
+
+        if found:
+            index, (_, converters, handler), args = found
+            return handler, convert_args(args, converters)
+
+        return None, None
+
+    def _search(self, node, segments, depth, args):
+        """ Returns prior (index, route, args) or none """
+        if depth == len(segments):
+            if node[3]:
+                return node[3][0], node[3], args
+            return None
+
+        segment = segments[depth]
+        found = []
+
+        if segment in node[0]:
+            found.append(self._search(node[0][segment], segments, depth + 1, args))
+
+        if node[1] and segment and not segment.strip("0123456789"):
+            found.append(self._search(node[1], segments, depth + 1, args + [segment]))
+
+        if node[2] and segment:
+            found.append(self._search(node[2], segments, depth + 1, args + [segment]))
+
+        found = [f for f in found if f]
+        return min(found) if found else None
+
+
+class AlternationRouter(object):
+    """ Combines routes of each method into one alternation regex
+
+    Alternatives keep priority order, so the first alternative that matches
+    is the winning route. Python 2 regex supports at most 100 groups, so
+    routes are split into several alternations when needed.
+    """
+    MAX_GROUPS = 100
+
+    def __init__(self, table):
+        routes = {}  # method -> [(name, pattern, converters, handler)]
+        for index, (methods, pattern, converters, _, handler) in enumerate(table):
+            for method in methods:
+                item = ("_%d" % index, pattern, converters, handler)
+                routes.setdefault(method, []).append(item)
+
+        self.chunks = {}  # method -> [(regex, {group name: route})]
+        for method, items in routes.items():
+            self.chunks[method] = []
+
+            alternatives, chunk_routes, size = [], {}, 0
+            for name, pattern, converters, handler in items:
+                inner = pattern.pattern[1:-1]  # without `^` and `$`
+
+                # inline flags and backreferences would affect whole alternation
+                isolated = "(?" in inner or re.search("\\\\[1-9]", inner)
+
+                if alternatives and (isolated or size + pattern.groups + 1 > self.MAX_GROUPS):
+                    self._add_chunk(method, alternatives, chunk_routes)
+                    alternatives, chunk_routes, size = [], {}, 0
+
+                if isolated:
+                    self.chunks[method].append((pattern, (converters, handler)))
+                    continue
+
+                alternatives.append("(?P<%s>%s)$" % (name, inner))
+                chunk_routes[name] = (pattern.groups, converters, handler)
+                size += pattern.groups + 1
+
+            if alternatives:
+                self._add_chunk(method, alternatives, chunk_routes)
+
+    def _add_chunk(self, method, alternatives, routes):
+        regex = re.compile("(?:%s)" % "|".join(alternatives))
+        self.chunks[method].append((regex, routes))
+
+    def match(self, request_path, request_method):
+        """ Returns (handler, args) or (none, none) """
+        for regex, routes in self.chunks.get(request_method, []):
+            match = regex.match(request_path)
+            if not match:
+                continue
+
+            " isolated route "
+            if isinstance(routes, tuple):
+                converters, handler = routes
+                return handler, convert_args(match.groups(), converters)
+
+            groups, converters, handler = routes[match.lastgroup]
+            start = regex.groupindex[match.lastgroup]
+            return handler, convert_args(match.groups()[start:start + groups], converters)
+
+        return None, None
+
+
+ROUTERS = {
+    "regex": RegexRouter,
+    "trie": TrieRouter,
+    "alternation": AlternationRouter,
+}
+
+
+class LRUCache(object):
+    """ Bounded mapping. Least recently used item is dropped when full
+
+    Thread safe: OrderedDict reordering is guarded by lock
+    """
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+
+            # move to most recently used
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):  # noqa: A003
+        if self.size <= 0:
+            return  # disabled
+
+        with self.lock:
+            self.items.pop(key, None)
+            if len(self.items) >= self.size:
+                self.items.popitem(last=False)
+            self.items[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class FileWrapper(object):
+    """ Fallback of server `wsgi.file_wrapper`. Iterates file by blocks """
+    __slots__ = ("file", "block_size")
+
+    def __init__(self, file_, block_size=BodyStream.CHUNK_SIZE):
+        self.file = file_
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.file.read(self.block_size), "")
+
+    def close(self):
+        self.file.close()
+
+
+def stream_body(chunks, iterable):
+    """ WSGI body of written chunks and streamed iterable """
+    try:
+        for chunk in chunks:
+            yield chunk
+
+        for chunk in iterable:
+            yield ensure_ascii(chunk)
+    except Exception:
+        # response already started, can not be changed
+        error("Error occured in streamed response", exc_info=True)
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+
+def compress_stream(compressor, chunks, iterable):
+    """ Compress chunks and iterable. Each chunk is flushed to client
+
+    Errors are logged and iterable is closed by `stream_body`
+    """
+    body = stream_body(chunks, iterable)
+    try:
+        for chunk in body:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        body.close()
+
+
+def byteranges(parts, closing):
+    """ Body of `multipart/byteranges` response
+
+    parts - [(part head, read function, start, stop)]
+    """
+    for head, read, start, stop in parts:
+        yield head
+        for chunk in read(start, stop):
+            yield chunk
+        yield "\r\n"
+    yield closing
+
+
+def read_file(file_, start, stop, block_size=64 * 1024):
+    """ Read file from `start` until `stop` offset by blocks """
+    file_.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = file_.read(min(block_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def closing_iterator(iterable, file_):
+    """ Iterate and close the file at the end """
+    try:
+        for chunk in iterable:
+            yield chunk
+    finally:
+        file_.close()
+
+
+def parse_range(header, size, max_ranges=16):
+    """ Parse `Range` header for body of `size` bytes
+
+    Returns sorted [(start, stop)], overlapping and adjacent ranges merged.
+    Empty if unsatisfiable, none if invalid or more than `max_ranges`
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+
+    specs = specs.split(",")
+    if len(specs) > max_ranges:
+        return None  # abusive, whole body is sent
+
+    ranges = []
+    for spec in specs:
+        start, dash, end = spec.strip().partition("-")
+        if not dash:
+            return None
+
+        try:
+            if not start:
+                # suffix range. Example: `-500` last 500 bytes
+                length = int(end)
+                if length < 0:
+                    return None
+                start, stop = max(size - length, 0), size
+            else:
+                start = int(start)
+                stop = int(end) + 1 if end else size
+                if start < 0 or end and stop <= start:
+                    return None
+        except ValueError:
+            return None
+
+        if start < size and start < stop:
+            ranges.append((start, min(stop, size)))
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def is_fresh(environ, etag=None, last_modified=None):
+    """ Client cached copy is fresh
+
+    Checks `If-None-Match` with ETag, or else `If-Modified-Since` with
+    Last-Modified. Encoding suffix of strong ETag is ignored
+    """
+    def normalize(tag):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        return re.sub('-(gzip|deflate)"$', '"', tag)
+
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match:
+        if not etag:
+            return False
+
+        if if_none_match.strip() == "*":
+            return True
+
+        return normalize(etag) in [normalize(t) for t in if_none_match.split(",")]
+
+    if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+    if if_modified_since and last_modified:
+        since = parse_http_date(if_modified_since)
+        modified = parse_http_date(last_modified)
+        return since is not None and modified is not None and modified <= since
+
+    return False
+
+
+def http_date(value):
+    """ Format datetime (UTC) or timestamp as HTTP date """
+    if isinstance(value, datetime):
+        value = calendar.timegm(value.utctimetuple())
+    return formatdate(value, usegmt=True)
+
+
+def parse_http_date(value):
+    """ Returns timestamp of HTTP date or none """
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def parse_accept_encoding(header):
+    """ Parse `Accept-Encoding` header
+
+    Returns {coding: quality}
+    """
+    codings = {}
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+
+        quality = 1.0
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        codings[coding] = quality
+
+    return codings
+
+
+def add_vary(headers, name):
+    """ Add request header name to `Vary` response header """
+    vary = headers.get("Vary")
+    if not vary:
+        headers["Vary"] = name
+    elif name.lower() not in vary.lower():
+        headers["Vary"] = "%s, %s" % (vary, name)
+
+
+def header_list(headers):
+    """ WSGI header list. List value is sent as several same name headers
+
+    Response headers must be str not unicode. Values with characters other
+    than printable ASCII are quoted
+    """
+    result = []
+    for name, value in headers.iteritems():
+        for value in (value if isinstance(value, list) else [value]):
+            if not isinstance(value, basestring):
+                value = str(value)
+            if not isinstance(value, str) or UNSAFE_HEADER_RE.search(value):
+                value = urllib.quote(ensure_ascii(value), safe=string.printable)
+            result.append((name, value))
+    return result
+
+
+def convert_args(groups, converters):
+    """ Apply route converters to matched groups """
+    args = list(groups)
+    for i, convert in enumerate(converters):
+        if convert:
+            args[i] = convert(args[i])
+    return args
+
+
 def ensure_unicode(string):
     if isinstance(string, str):
         try:
@@ -948,5 +2536,49 @@ def _update():
         open("natrix-%s.py" % latest_version, "w+").write(source_latest)
 
 
+def _compile_templates():
+    """ Compile templates to python modules, load by `template-compiled` config
+
+    Usage: python natrix.py compile-templates [--template-path=./templates]
+      [--plugins=a,b] [--autoescape] [--filters=a,b] [--extensions=html,txt]
+      [--target=./templates-compiled]
+
+    Filters given by context functions must be listed in `--filters`
+    """
+    options = {}
+    for arg in sys.argv[2:]:
+        name, _, value = arg.lstrip("-").partition("=")
+        options[name] = value
+
+    def option_list(name):
+        return [i.strip() for i in options.get(name, "").split(",") if i.strip()]
+    # endfold
+
+    env = jinja_environment({
+        "template-path": options.get("template-path") or "./templates",
+        ":plugins": option_list("plugins"),
+        "jinja:autoescape": "autoescape" in options,
+    })
+
+    # context functions are known on render only
+    env.filters.push({name: None for name in option_list("filters")})
+
+    target = options.get("target") or "./templates-compiled"
+    try:
+        env.compile_templates(target, extensions=option_list("extensions") or None,
+                              zip=None, ignore_errors=False,
+                              log_function=lambda x: sys.stdout.write("%s\n" % x))
+    except jinja2.TemplateError as e:
+        sys.stderr.write("ERROR: %s\n" % ensure_ascii(e.message))
+        if isinstance(e, jinja2.TemplateSyntaxError):
+            sys.stderr.write('  File "%s", line %s\n' % (e.filename or e.name, e.lineno))
+        sys.exit(1)
+
+
 if __name__ == "__main__":
-    _update()
+    if sys.argv[1:2] == ["compile-templates"]:
+        # compiled templates refer to extensions of `natrix`, not `__main__`
+        import natrix
+        natrix._compile_templates()
+    else:
+        _update()
@@ -1,13 +1,22 @@
 # coding: utf-8
+import os
 import re
+import sys
 import time
+import zlib
 import pytest
 import natrix
+import jinja2
 import shutil
 import urllib
 import webtest
+import hashlib
 import tempfile
+import threading
+import subprocess
 import dev_appserver
+from StringIO import StringIO
+from datetime import datetime
 
 
 def setup():
@@ -70,6 +79,25 @@ def validate_response(r, **options):
     # endfold
 
 
+def call_app(app, path, **environ):
+    """ Call WSGI app directly. Webtest decodes compressed response
+
+    Returns (status, headers, body)
+    """
+    environ.setdefault("REQUEST_METHOD", "GET")
+    environ.setdefault("QUERY_STRING", "")
+    environ["PATH_INFO"] = path
+
+    result = {}
+
+    def start_response(status, headers):
+        result["status"] = status
+        result["headers"] = dict(headers)
+
+    body = "".join(app(environ, start_response))
+    return result["status"], result["headers"], body
+
+
 # Core classes
 def test_Request():
     """ Tests `natrix.Request` class individually """
@@ -95,6 +123,46 @@ def test_Request():
     assert request.method == "POST"
     assert request.path == u"/\xff"
 
+    # lazy fields
+    environ = {
+        "PATH_INFO": "/lazy",
+        "REQUEST_METHOD": "GET",
+        "QUERY_STRING": "a=b",
+        "HTTP_HOST": "foo.example.com:8000",
+        "wsgi.input": None,  # not read
+    }
+    request = natrix.Request(environ)
+    assert request.url == u"http://foo.example.com:8000/lazy?a=b"
+    assert request.port == 8000
+    assert request.method == "GET"
+    assert not hasattr(request, "_params")
+    assert not hasattr(request, "_cookies")
+
+    request.path = u"/changed"
+    assert request.path == u"/changed"
+
+
+def test_Request_slots():
+    request = natrix.Request({"PATH_INFO": "/", "REQUEST_METHOD": "GET"})
+    assert request.__dict__ == {}
+
+    # extension points
+    request.context = {"a": "b"}
+    request.user = "user"
+    assert request.__dict__ == {"user": "user"}
+
+    response = natrix.Response()
+    response.user = "user"
+    assert response.__dict__ == {"user": "user"}
+
+    handler = natrix.Handler(request, response, {})
+    handler.user = "user"
+    assert handler.user == "user"
+
+    session = natrix.Session({"a": "b"})
+    assert session.initial == {"a": "b"}
+    assert not hasattr(session, "__dict__")
+
 
 def test_Request_headers():
     app = natrix.Application([])
@@ -127,6 +195,18 @@ def test_Response():
     assert natrix.Response(code=301).status == "301 Moved Permanently"
     assert natrix.Response(code=302).status == "302 Found"
     assert natrix.Response(code=404).status == "404 Not Found"
+    assert natrix.Response(code=510).status == "510 Not Extended"
+    assert natrix.Response(code=299).status == "299 Success"
+    assert natrix.Response(code=499).status == "499 Client Error"
+    assert natrix.Response(code=999).status == "999 Unknown"
+
+    # Response.add_header
+    response = natrix.Response()
+    response.add_header("Set-Cookie", "a=1")
+    assert response.headers["Set-Cookie"] == "a=1"
+    response.add_header("Set-Cookie", "b=2")
+    response.add_header("Set-Cookie", "c=3")
+    assert response.headers["Set-Cookie"] == ["a=1", "b=2", "c=3"]
 
     # Response.write
     response = natrix.Response()
@@ -137,6 +217,25 @@ def test_Response():
     response.write([1, 2], encode="json")
     assert response.body == "[1, 2]"
 
+    response = natrix.Response()
+    for i in range(3):
+        response.write(i)
+    response.write(u"юникод")
+    assert response.chunks == ["0", "1", "2", "юникод"]
+    assert response.body == "012юникод"
+    assert response.chunks == ["012юникод"]
+
+    response.body = u"ok"
+    response.write("!")
+    assert response.body == "ok!"
+
+    # replaced stream is closed
+    stream = StringIO("streamed")
+    response.stream(stream)
+    response.body = ""
+    assert stream.closed
+    assert response.iterable is None
+
     # Response(...)
     response = natrix.Response()
     try:
@@ -265,6 +364,239 @@ def test_Handler_render(tempdir):
     validate_response(r)
 
 
+def test_Handler_render_environment(tempdir):
+    """ Jinja environment is reused, context is passed per render """
+    open("%s/filter.html" % tempdir, "w+").write(
+        "{{ 'a'|shout }} {{ [3, 1]|max }} {{ request.path }}",
+    )
+
+    app = natrix.Application([
+        ("/<string>", lambda x, name: x.render("%s.html" % name)),
+    ], config={
+        "context": lambda x: {"shout": lambda s: s.upper() + x.request.path},
+    })
+    app.config["template-path"] = tempdir
+    testapp = webtest.TestApp(app)
+
+    response = testapp.get("/filter")
+    assert response.normal_body == "A/filter 3 /filter"
+    env = app.config[":jinja"][1]
+
+    response = testapp.get("/ok")
+    assert response.normal_body == "<b>ok хорошо /ok</b>"
+    assert app.config[":jinja"][1] is env
+    assert "request" not in env.globals
+    assert "shout" not in env.filters
+
+    # context filter is not evaluated on compile
+    app.config["context"] = lambda x: {"shout": lambda s: s.upper() + x.request.query}
+    response = testapp.get("/filter?1")
+    assert response.normal_body == "A1 3 /filter"
+    response = testapp.get("/filter?2")
+    assert response.normal_body == "A2 3 /filter"
+
+    # template config change builds new environment
+    app.config["jinja:autoescape"] = True
+    response = testapp.get("/filter?3")
+    assert response.normal_body == "A3 3 /filter"
+    assert app.config[":jinja"][1] is not env
+
+
+def test_Handler_render_filter(tempdir):
+    """ Context function filter is not shared between requests """
+    open("%s/who.html" % tempdir, "w+").write("{{ 'a'|who }} {{ 'b'|who(request.query) }}")
+
+    app = natrix.Application([
+        ("/", lambda x: x.render("who.html")),
+    ], config={
+        "context": lambda x: {"who": lambda s, *args: s + x.request.query + "".join(args)},
+    })
+    app.config["template-path"] = tempdir
+    testapp = webtest.TestApp(app)
+
+    assert testapp.get("/?alice").normal_body == "aalice balicealice"
+    assert testapp.get("/?bob").normal_body == "abob bbobbob"
+
+
+def test_Handler_render_bytecode_cache(tempdir, testbed):
+    def compile_error(*args, **kwargs):
+        raise AssertionError("template is compiled")
+    # endfold
+
+    def application():
+        app = natrix.Application([
+            ("/ok", lambda x: x.render("ok.html")),
+        ])
+        app.config["template-path"] = tempdir
+        app.config["jinja:bytecode-cache"] = True
+        return app
+    # endfold
+
+    # compiled by first instance
+    app = application()
+    response = webtest.TestApp(app).get("/ok")
+    assert response.normal_body == "<b>ok хорошо /ok</b>"
+    assert natrix.memcache.get_stats()["items"] == 1
+
+    # loaded from memcache by next instance
+    app = application()
+    app.config["jinja:bytecode-cache-dir"] = tempdir
+    natrix.jinja_environment(app.config).compile = compile_error
+    response = webtest.TestApp(app).get("/ok")
+    assert response.normal_body == "<b>ok хорошо /ok</b>"
+
+    # local file cache
+    natrix.memcache.flush_all()
+    app = application()
+    app.config["jinja:bytecode-cache-dir"] = tempdir
+    natrix.jinja_environment(app.config).compile = compile_error
+    response = webtest.TestApp(app).get("/ok")
+    assert response.normal_body == "<b>ok хорошо /ok</b>"
+
+    # changed template is compiled again
+    open("%s/ok.html" % tempdir, "w+").write("changed")
+    app = application()
+    response = webtest.TestApp(app).get("/ok")
+    assert response.normal_body == "changed"
+    assert natrix.memcache.get_stats()["items"] == 1
+
+
+def test_Handler_render_cache(tempdir, testbed, monkeypatch):
+    """ Tests `{% cache %}` template tag """
+    open("%s/cache.html" % tempdir, "w+").write(
+        "{% cache 'nav', 60, request.path %}<b>{{ count() }}{{ '<' }}</b>{% endcache %}",
+    )
+    counter = []
+
+    def count():
+        counter.append(1)
+        return len(counter)
+    # endfold
+
+    app = natrix.Application([
+        ("/<string>", lambda x, name: x.render("cache.html")),
+    ], config={
+        "context": {"count": count},
+    })
+    app.config["template-path"] = tempdir
+    app.config["jinja:autoescape"] = True
+    testapp = webtest.TestApp(app)
+
+    assert testapp.get("/a").body == "<b>1&lt;</b>"
+    assert testapp.get("/a").body == "<b>1&lt;</b>"
+    assert testapp.get("/b").body == "<b>2&lt;</b>"
+
+    # shared by memcache
+    env = natrix.jinja_environment(app.config)
+    env.fragment_cache.clear()
+    assert testapp.get("/a").body == "<b>1&lt;</b>"
+    assert testapp.get("/b").body == "<b>2&lt;</b>"
+
+    # expired
+    for key, (expires, value) in list(env.fragment_cache.items.items()):
+        env.fragment_cache.set(key, (expires - 61, value))
+        natrix.memcache.set(key, (expires - 61, value))
+    assert testapp.get("/a").body == "<b>3&lt;</b>"
+
+    # key is scoped by template and app version
+    for name in ["one", "two"]:
+        open("%s/%s.html" % (tempdir, name), "w+").write(
+            "{% cache 'footer' %}{{ count() }}{% endcache %}",
+        )
+    app.route("/page/<string>")(lambda x, name: x.render("%s.html" % name))
+
+    assert testapp.get("/page/one").body == "4"
+    assert testapp.get("/page/two").body == "5"
+    assert testapp.get("/page/one").body == "4"
+
+    monkeypatch.setenv("CURRENT_VERSION_ID", "2.123")
+    assert testapp.get("/page/one").body == "6"
+
+    # default time to live
+    expires = max(e for e, _ in env.fragment_cache.items.values())
+    assert 3590 < expires - time.time() <= 3600
+
+    # in-process cache is created once
+    cache = env.fragment_cache
+    natrix.FragmentCacheExtension(env)
+    assert env.fragment_cache is cache
+
+
+def test_Handler_render_stream(tempdir, monkeypatch):
+    open("%s/stream.html" % tempdir, "w+").write(
+        "<head>{% flush %}{% for i in items %}{{ i|double }}{% endfor %}{% flush %}</body>",
+    )
+
+    def stream(x):
+        x.render_stream("stream.html", items=[1, 2], double=lambda i: i * 2)
+
+    def stream_missing(x):
+        x.render_stream("missing.html")
+    # endfold
+
+    app = natrix.Application([
+        ("/", lambda x: x.render("stream.html", items=[1, 2], double=lambda i: i * 2)),
+        ("/stream", stream),
+        ("/stream-missing", stream_missing),
+    ])
+    app.config["template-path"] = tempdir
+
+    def start_response(status, headers):
+        assert status == "200 OK"
+        assert dict(headers)["Content-Type"] == "text/html; charset=UTF-8"
+    # endfold
+
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/stream", "QUERY_STRING": ""}
+    assert list(app(environ, start_response)) == ["<head>", "24", "</body>"]
+
+    # flush is ignored when not streamed
+    status, _, body = call_app(app, "/")
+    assert body == "<head>24</body>"
+
+    # template error before response started
+    monkeypatch.setattr(natrix, "error", lambda *args, **kwargs: None)
+    status, _, _ = call_app(app, "/stream-missing")
+    assert status == "500 Internal Server Error"
+
+
+def test_Handler_render_stream_buffered(tempdir, testbed):
+    """ Flush inside macro, include and fragment cache """
+    open("%s/head.html" % tempdir, "w+").write("<head>{% flush %}")
+    open("%s/macro.html" % tempdir, "w+").write(
+        "{% macro head() %}<head>{% flush %}{% endmacro %}{{ head()|upper }}body",
+    )
+    open("%s/include.html" % tempdir, "w+").write("{% include 'head.html' %}body")
+    open("%s/cache.html" % tempdir, "w+").write(
+        "{% cache 'head' %}<head>{% flush %}{% endcache %}body",
+    )
+    open("%s/filter.html" % tempdir, "w+").write(
+        "{% filter upper %}<head>{% flush %}{% endfilter %}body",
+    )
+
+    app = natrix.Application([
+        ("/<string>", lambda x, name: x.render_stream("%s.html" % name)),
+        ("/render/<string>", lambda x, name: x.render("%s.html" % name)),
+    ])
+    app.config["template-path"] = tempdir
+
+    def chunks(path):
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": ""}
+        return list(app(environ, lambda status, headers: None))
+    # endfold
+
+    assert chunks("/macro") == ["<HEAD>", "body"]
+    assert chunks("/include") == ["<head>", "body"]
+
+    # marker is not cached
+    assert chunks("/cache") == ["<head>", "body"]
+    assert chunks("/cache") == ["<head>body"]
+    assert chunks("/render/cache") == ["<head>body"]
+
+    # filter block can change marker
+    with pytest.raises(jinja2.TemplateSyntaxError):
+        natrix.jinja_environment(app.config).get_template("filter.html")
+
+
 def test_Handler_redirect():
     app = natrix.Application([
         ("/0", lambda x: x.redirect("/2")),
@@ -383,16 +715,140 @@ def test_Handler_request_upload():
 
     f = ("readme", "readme.md", "Lorem ipsum dolot sit amet")
     response = testapp.post("/1", {"a": "b"}, upload_files=[f])
-    assert response.normal_body == ("FieldStorage('readme', 'readme.md')")
+    assert response.normal_body == ("Upload('readme', 'readme.md')")
 
     f = ("readme", "readme.md", "Lorem ipsum dolot sit amet")
     response = testapp.post("/1", {":method": "upload"}, upload_files=[f])
-    assert response.normal_body == ("FieldStorage('readme', 'readme.md')")
+    assert response.normal_body == ("Upload('readme', 'readme.md')")
 
     f = ("readme", "readme.md", "Lorem ipsum dolot sit amet")
     x = ("readme", "readme.txt", "Ut enim ad minim veniam, quis nostrud")
     response = testapp.post("/1", {":method": "upload"}, upload_files=[f, x])
-    assert response.normal_body == ("FieldStorage('readme', 'readme.md')")
+    assert response.normal_body == ("Upload('readme', 'readme.md')")
+
+
+def test_Handler_request_body():
+    app = natrix.Application([
+        ("/data#post", lambda x: x.response("%s %r" % (x.request.data, x.request.params))),
+        ("/stream#post", lambda x: x.response(x.request.stream.read(5))),
+        ("/file#post", lambda x: x.response("%s" % x.request.body_file._rolled)),
+        ("/ignore#post", lambda x: x.response("ignored")),
+    ])
+    app.config["request-max-size"] = 20
+    app.config["request-spool-size"] = 5
+    testapp = webtest.TestApp(app)
+
+    # form parsing only for `application/x-www-form-urlencoded`
+    response = testapp.post("/data", "a=b", content_type="text/plain")
+    assert response.normal_body == "a=b {}"
+
+    response = testapp.post("/data", "a=b")
+    assert response.normal_body == "a=b {'a': ['b']}"
+
+    response = testapp.post("/stream", "hello world", content_type="text/plain")
+    assert response.normal_body == "hello"
+
+    response = testapp.post("/file", "hello world")
+    assert response.normal_body == "True"
+
+    # too large body
+    response = testapp.post("/data", "a" * 21, status=413)
+    assert response.normal_body == "Error 413"
+
+    response = testapp.post("/ignore", "a" * 21, content_type="text/plain")
+    assert response.normal_body == "ignored"
+
+    # without content length
+    stream = natrix.BodyStream(StringIO("a" * 21), max_size=20)
+    with pytest.raises(natrix.Response.Abort):
+        stream.read()
+
+    stream = natrix.BodyStream(StringIO("abc\ndef"), length=6)
+    assert list(stream) == ["abc\n", "de"]
+
+    # explicit zero length is not read, as input can block
+    class BlockingInput(object):
+        def read(self, *args):
+            raise AssertionError("wsgi.input is read")
+    # endfold
+
+    request = natrix.Request({"CONTENT_LENGTH": "0", "wsgi.input": BlockingInput()})
+    assert request.stream.read() == ""
+
+    for content_length in [None, "", " "]:
+        environ = {"wsgi.input": StringIO("abc")}
+        if content_length is not None:
+            environ["CONTENT_LENGTH"] = content_length
+        assert natrix.Request(environ).stream.read() == "abc"
+
+
+def test_Handler_request_multipart(monkeypatch):
+    def upload(x):
+        files = x.request.params["file"]
+        x.response(repr([x.request.params["a"], [(f.filename, f.type, f.value) for f in files]]))
+    # endfold
+
+    app = natrix.Application([
+        ("/#post", upload),
+    ])
+    app.config["request-spool-size"] = 10
+    app.config["request-part-max-size"] = 100
+    testapp = webtest.TestApp(app)
+
+    # multi-value fields
+    files = [
+        ("file", "1.txt", "one"),
+        ("file", "2.txt", "two " * 10),
+    ]
+    response = testapp.post("/", [("a", "b"), ("a", "c")], upload_files=files)
+    assert response.normal_body == ("[['b', 'c'], [('1.txt', 'text/plain', 'one'),"
+                                    " ('2.txt', 'text/plain', '%s')]]" % ("two " * 10))
+
+    # too large part
+    files = [("file", "1.txt", "x" * 101)]
+    response = testapp.post("/", {"a": "b"}, upload_files=files, status=413)
+    assert response.normal_body == "Error 413"
+
+    # parser directly. boundary split between chunks
+    body = ('preamble\r\n--xyz\r\nContent-Disposition: form-data; name="a"\r\n\r\n'
+            'hello\r\n--xyz\r\nContent-Disposition: form-data; name="a"\r\n\r\n'
+            "world\r\n--xyz--\r\n")
+    with monkeypatch.context() as patch:
+        patch.setattr(natrix.BodyStream, "CHUNK_SIZE", 7)
+        params = natrix.MultipartParser(StringIO(body), "xyz").parse()
+    assert params == {"a": ["hello", "world"]}
+
+    # truncated body
+    with pytest.raises(natrix.Response.Abort):
+        natrix.MultipartParser(StringIO(body[:-20]), "xyz").parse()
+
+    # empty file input
+    body = ('--xyz\r\nContent-Disposition: form-data; name="photo"; filename=""\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n\r\n--xyz--\r\n")
+    params = natrix.MultipartParser(StringIO(body), "xyz").parse()
+    assert params == {"photo": [""]}
+
+
+def test_Handler_request_json(monkeypatch):
+    app = natrix.Application([
+        ("/#post", lambda x: x.response(repr([x.request.json, x.request.params]))),
+    ])
+    testapp = webtest.TestApp(app)
+
+    response = testapp.post("/?a=b", '{"hello": [1, 2]}', content_type="application/json")
+    assert response.normal_body == "[{u'hello': [1, 2]}, {'a': ['b']}]"
+
+    response = testapp.post("/", "", content_type="application/json")
+    assert response.normal_body == "[None, {}]"
+
+    monkeypatch.setattr(natrix, "info", lambda x: x)
+    response = testapp.post("/", "{hello", content_type="application/json", status=400)
+    assert response.normal_body == "Error 400"
+
+    # custom decoder
+    app.config["json-decoder"] = lambda data: data.upper()
+    response = testapp.post("/", "{hello", content_type="application/json")
+    assert response.normal_body == "['{HELLO', {}]"
 
 
 def test_Handler_session():
@@ -435,6 +891,19 @@ def test_Handler_session():
     response = testapp.get("/flash_fetch")
     assert response.normal_body == "Foo"
 
+    # session cookie is added to cookies set by handler
+    def cookie(x):
+        x.response.add_header("Set-Cookie", "theme=dark; path=/")
+        x.session["hello"] = "mars"
+        x.response("OK")
+    # endfold
+
+    app.route("/cookie")(cookie)
+    response = testapp.get("/cookie")
+    cookies = response.headers.getall("Set-Cookie")
+    assert cookies[0] == "theme=dark; path=/"
+    assert cookies[1].startswith("session=")
+
 
 def test_Handler_session_before():
     """ Tests `x.session` with route(:before) """
@@ -453,6 +922,24 @@ def test_Handler_session_before():
     response = testapp.get("/1")
     assert response.normal_body == "{u'foo': u'bar'}"
 
+    # before hook and handler change session
+    def change(x):
+        x.response.add_header("Set-Cookie", "theme=dark")
+        x.session["baz"] = "qux"
+        x.response("OK")
+    # endfold
+
+    app.route("/2")(change)
+    testapp = webtest.TestApp(app)
+    response = testapp.get("/2")
+    cookies = response.headers.getall("Set-Cookie")
+    assert len(cookies) == 2
+    assert cookies[0] == "theme=dark"
+    assert cookies[1].startswith("session=")
+
+    response = testapp.get("/1")
+    assert response.normal_body == "{u'foo': u'bar', u'baz': u'qux'}"
+
 
 def test_Handler_session_negative():
     """ Tests session negative cases """
@@ -589,6 +1076,400 @@ def test_Application():
     assert response.content_type == "text/plain"
 
 
+def test_Application_stream(monkeypatch):
+    def stream(x):
+        x.response.write("head ")
+        x.response.stream(str(i) for i in range(3))
+
+    def generator(x):
+        x.response.headers["Content-Type"] = "text/csv"
+        x.session["hello"] = "earth"
+        yield "a,b\n"
+        yield u"ү,1\n"
+
+    def broken(x):
+        yield "ok"
+        raise ValueError
+
+    def redirect(x):
+        x.redirect("/stream")
+        yield "never"
+    # endfold
+
+    app = natrix.Application([
+        ("/stream", stream),
+        ("/generator", generator),
+        ("/broken", broken),
+        ("/redirect", redirect),
+    ])
+    app.config["session-key"] = "random-string"
+    testapp = webtest.TestApp(app)
+
+    response = testapp.get("/stream")
+    assert response.normal_body == "head 012"
+
+    response = testapp.get("/generator")
+    assert response.body == "a,b\nү,1\n"
+    assert response.content_type == "text/csv"
+    assert "session=" in response.headers["Set-Cookie"]
+
+    response = testapp.head("/generator")
+    assert response.normal_body == ""
+
+    monkeypatch.setattr(natrix, "error", lambda *args, **kwargs: None)
+    response = testapp.get("/broken")
+    assert response.normal_body == "ok"
+
+    response = testapp.get("/redirect")
+    assert response.status_int == 302
+    assert response.normal_body == ""
+
+
+def test_Application_compress(monkeypatch):
+    def stream(x):
+        x.response.stream("line %d\n" % i for i in range(100))
+
+    def broken():
+        yield "first\n"
+        raise ValueError("broken")
+
+    def image(x):
+        x.response.headers["Content-Type"] = "image/png"
+        x.response("x" * 2000)
+    # endfold
+
+    app = natrix.Application([
+        ("/small", lambda x: x.response("small")),
+        ("/large", lambda x: x.response("large " * 1000)),
+        ("/stream", stream),
+        ("/broken", lambda x: x.response.stream(broken())),
+        ("/image", image),
+    ])
+    app.config["compress"] = True
+
+    def get(path, accept_encoding=None):
+        environ = {"HTTP_ACCEPT_ENCODING": accept_encoding} if accept_encoding else {}
+        return call_app(app, path, **environ)[1:]
+    # endfold
+
+    headers, body = get("/large", "gzip, deflate")
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Vary"] == "Accept-Encoding"
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == "large " * 1000
+
+    headers, body = get("/large", "gzip;q=0, deflate")
+    assert headers["Content-Encoding"] == "deflate"
+    assert zlib.decompress(body) == "large " * 1000
+
+    headers, body = get("/large")
+    assert "Content-Encoding" not in headers
+    assert headers["Vary"] == "Accept-Encoding"
+    assert body == "large " * 1000
+
+    headers, body = get("/small", "gzip")
+    assert "Content-Encoding" not in headers
+    assert body == "small"
+
+    headers, body = get("/image", "gzip")
+    assert "Content-Encoding" not in headers
+
+    headers, body = get("/stream", "gzip")
+    assert headers["Content-Encoding"] == "gzip"
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == "".join(
+        "line %d\n" % i for i in range(100))
+
+    # error in stream is logged, compressed part is finished
+    errors = []
+    monkeypatch.setattr(natrix, "error", lambda *args, **kwargs: errors.append(args))
+    headers, body = get("/broken", "gzip")
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == "first\n"
+    assert errors == [("Error occured in streamed response",)]
+
+    # HEAD and 304 have headers of GET response
+    app.config["etag"] = "strong"
+    _, get_headers, _ = call_app(app, "/large", HTTP_ACCEPT_ENCODING="gzip")
+    status, headers, body = call_app(app, "/large", REQUEST_METHOD="HEAD",
+                                     HTTP_ACCEPT_ENCODING="gzip")
+    assert body == ""
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Vary"] == "Accept-Encoding"
+    assert headers["ETag"] == get_headers["ETag"]
+
+    status, headers, body = call_app(app, "/large", HTTP_ACCEPT_ENCODING="gzip",
+                                     HTTP_IF_NONE_MATCH=get_headers["ETag"])
+    assert status == "304 Not Modified"
+    assert body == ""
+    assert headers["Vary"] == "Accept-Encoding"
+    assert headers["ETag"] == get_headers["ETag"]
+    del app.config["etag"]
+
+    # compressed body is sent whole, identity body by ranges
+    assert "Accept-Ranges" not in get_headers
+    status, headers, body = call_app(app, "/large", HTTP_ACCEPT_ENCODING="gzip",
+                                     HTTP_RANGE="bytes=0-4")
+    assert status == "200 OK"
+    assert headers["Content-Encoding"] == "gzip"
+
+    status, headers, body = call_app(app, "/large", HTTP_RANGE="bytes=0-4")
+    assert status == "206 Partial Content"
+    assert headers["Vary"] == "Accept-Encoding"
+    assert body == "large"
+
+    # webtest decodes
+    testapp = webtest.TestApp(app)
+    response = testapp.get("/large", headers={"Accept-Encoding": "gzip"})
+    assert response.body == "large " * 1000
+
+
+def test_Application_etag():
+    def entity(x):
+        x.not_modified(etag=123, last_modified=datetime(2020, 1, 2, 3, 4, 5))
+        x.response("rendered")
+    # endfold
+
+    app = natrix.Application([
+        ("/", lambda x: x.response("hello " * 300)),
+        ("/entity", entity),
+        ("/post#post", lambda x: x.response("post")),
+    ])
+    app.config["etag"] = "strong"
+    testapp = webtest.TestApp(app)
+
+    response = testapp.get("/")
+    etag = response.headers["ETag"]
+    assert etag == '"%s"' % hashlib.md5("hello " * 300).hexdigest()
+
+    response = testapp.get("/", headers={"If-None-Match": etag})
+    assert response.status_int == 304
+    assert response.body == ""
+
+    response = testapp.get("/", headers={"If-None-Match": '"other", %s' % etag})
+    assert response.status_int == 304
+
+    response = testapp.get("/", headers={"If-None-Match": '"other"'})
+    assert response.status_int == 200
+
+    response = testapp.post("/post", headers={"If-None-Match": "*"})
+    assert response.status_int == 200
+
+    # precomputed validator
+    response = testapp.get("/entity")
+    assert response.headers["ETag"] == '"123"'
+    assert response.headers["Last-Modified"] == "Thu, 02 Jan 2020 03:04:05 GMT"
+    assert response.body == "rendered"
+
+    response = testapp.get("/entity", headers={"If-None-Match": '"123"'})
+    assert response.status_int == 304
+
+    response = testapp.get("/entity", headers={
+        "If-Modified-Since": "Thu, 02 Jan 2020 03:04:05 GMT",
+    })
+    assert response.status_int == 304
+
+    response = testapp.get("/entity", headers={
+        "If-Modified-Since": "Thu, 02 Jan 2020 03:04:04 GMT",
+    })
+    assert response.status_int == 200
+
+    # validator other than int or ETag characters is hashed
+    updated = datetime(2020, 1, 2, 3, 4, 5, 678)
+    for value, expected in [
+        (12, '"12"'),
+        ("v1.2", '"v1.2"'),
+        ("a b", '"%s"' % hashlib.md5(repr("a b")).hexdigest()),
+        ('"quoted"', '"%s"' % hashlib.md5(repr('"quoted"')).hexdigest()),
+        (updated, '"%s"' % hashlib.md5(repr(updated)).hexdigest()),
+    ]:
+        request = natrix.Request({"REQUEST_METHOD": "GET"})
+        x = natrix.Handler(request, natrix.Response(), {})
+        x.not_modified(etag=value)
+        assert x.response.headers["ETag"] == expected
+
+    # weak
+    app.config["etag"] = "weak"
+    response = testapp.get("/")
+    assert response.headers["ETag"].startswith('W/"')
+
+    # strong ETag with compression
+    app.config["etag"] = "strong"
+    app.config["compress"] = True
+    _, headers, _ = call_app(app, "/", HTTP_ACCEPT_ENCODING="gzip")
+    assert headers["ETag"] == etag[:-1] + '-gzip"'
+
+    status, _, _ = call_app(app, "/", HTTP_ACCEPT_ENCODING="gzip",
+                            HTTP_IF_NONE_MATCH=headers["ETag"])
+    assert status == "304 Not Modified"
+
+
+def test_Application_range():
+    def stream(x):
+        x.response.headers["Last-Modified"] = "Thu, 02 Jan 2020 03:04:05 GMT"
+        x.response.stream(StringIO("0123456789"))
+    # endfold
+
+    app = natrix.Application([
+        ("/", lambda x: x.response("0123456789")),
+        ("/large", lambda x: x.response("0123456789" * 100)),
+        ("/stream", stream),
+    ])
+    app.config["etag"] = "strong"
+
+    status, headers, body = call_app(app, "/")
+    assert status == "200 OK"
+    assert headers["Accept-Ranges"] == "bytes"
+    etag = headers["ETag"]
+
+    status, headers, body = call_app(app, "/", HTTP_RANGE="bytes=2-4")
+    assert status == "206 Partial Content"
+    assert headers["Content-Range"] == "bytes 2-4/10"
+    assert headers["Content-Length"] == "3"
+    assert body == "234"
+
+    _, headers, body = call_app(app, "/", HTTP_RANGE="bytes=-3")
+    assert headers["Content-Range"] == "bytes 7-9/10"
+    assert body == "789"
+
+    _, _, body = call_app(app, "/", HTTP_RANGE="bytes=8-100")
+    assert body == "89"
+
+    status, headers, body = call_app(app, "/", HTTP_RANGE="bytes=20-")
+    assert status == "416 Requested Range Not Satisfiable"
+    assert headers["Content-Range"] == "bytes */10"
+    assert body == ""
+
+    status, _, body = call_app(app, "/", HTTP_RANGE="lines=1-2")
+    assert status == "200 OK"
+    assert body == "0123456789"
+
+    # multiple ranges
+    status, headers, body = call_app(app, "/large", HTTP_RANGE="bytes=0-1,5-6")
+    assert status == "206 Partial Content"
+    content_type, boundary = headers["Content-Type"].split("; boundary=")
+    assert content_type == "multipart/byteranges"
+    part = ("--{0}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+            "Content-Range: bytes {1}/1000\r\n\r\n")
+    assert body == "".join([
+        part.format(boundary, "0-1"), "01\r\n",
+        part.format(boundary, "5-6"), "56\r\n",
+        "--%s--\r\n" % boundary,
+    ])
+    assert headers["Content-Length"] == str(len(body))
+
+    # multipart body larger than whole body
+    status, _, body = call_app(app, "/", HTTP_RANGE="bytes=0-1,5-6")
+    assert status == "200 OK"
+    assert body == "0123456789"
+
+    # overlapping ranges are merged, too many ranges are ignored
+    status, headers, body = call_app(app, "/", HTTP_RANGE="bytes=" + ",".join(["0-"] * 10))
+    assert status == "206 Partial Content"
+    assert headers["Content-Length"] == "10"
+    assert body == "0123456789"
+
+    status, headers, body = call_app(app, "/", HTTP_RANGE="bytes=" + ",".join(["0-"] * 200))
+    assert status == "200 OK"
+    assert body == "0123456789"
+
+    # If-Range
+    status, _, _ = call_app(app, "/", HTTP_RANGE="bytes=2-4", HTTP_IF_RANGE=etag)
+    assert status == "206 Partial Content"
+    status, _, body = call_app(app, "/", HTTP_RANGE="bytes=2-4", HTTP_IF_RANGE='"other"')
+    assert status == "200 OK"
+    assert body == "0123456789"
+
+    # streamed file
+    status, headers, body = call_app(app, "/stream", HTTP_RANGE="bytes=3-5")
+    assert status == "206 Partial Content"
+    assert headers["Content-Length"] == "3"
+    assert body == "345"
+
+    status, _, _ = call_app(app, "/stream", HTTP_RANGE="bytes=3-5",
+                            HTTP_IF_RANGE="Thu, 02 Jan 2020 03:04:05 GMT")
+    assert status == "206 Partial Content"
+    status, _, body = call_app(app, "/stream", HTTP_RANGE="bytes=3-5",
+                               HTTP_IF_RANGE="Thu, 02 Jan 2020 00:00:00 GMT")
+    assert status == "200 OK"
+    assert body == "0123456789"
+
+
+def test_Application_send_file(tempdir):
+    path = "%s/data.bin" % tempdir
+    open(path, "wb").write("0123456789" * 10000)
+    open("%s/ok.html.gz" % tempdir, "wb").write("compressed")
+    os.utime(path, (1577934245, 1577934245))
+
+    app = natrix.Application([
+        ("/data", lambda x: x.response.send_file(path)),
+        ("/ok", lambda x: x.response.send_file("%s/ok.html" % tempdir)),
+        ("/missing", lambda x: x.response.send_file("%s/missing" % tempdir)),
+    ])
+
+    status, headers, body = call_app(app, "/data")
+    assert status == "200 OK"
+    assert headers["Content-Type"] == "application/octet-stream"
+    assert headers["Content-Length"] == "100000"
+    assert headers["Last-Modified"] == "Thu, 02 Jan 2020 03:04:05 GMT"
+    assert headers["ETag"] == '"5e0d5da5-186a0"'
+    assert body == "0123456789" * 10000
+
+    # server file wrapper
+    wrapped = []
+
+    def file_wrapper(file_, block_size):
+        wrapped.append(block_size)
+        return natrix.FileWrapper(file_, block_size)
+    # endfold
+
+    _, _, body = call_app(app, "/data", **{"wsgi.file_wrapper": file_wrapper})
+    assert wrapped == [natrix.BodyStream.CHUNK_SIZE]
+    assert body == "0123456789" * 10000
+
+    # cache headers
+    status, _, body = call_app(app, "/data", HTTP_IF_NONE_MATCH='"5e0d5da5-186a0"')
+    assert status == "304 Not Modified"
+    assert body == ""
+
+    status, _, body = call_app(app, "/data", HTTP_RANGE="bytes=99998-")
+    assert status == "206 Partial Content"
+    assert body == "89"
+
+    # precompressed sibling
+    status, headers, body = call_app(app, "/ok", HTTP_ACCEPT_ENCODING="gzip")
+    assert headers["Content-Type"] == "text/html"
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Content-Length"] == "10"
+    assert headers["Vary"] == "Accept-Encoding"
+    assert headers["ETag"].endswith('-gzip"')
+    assert body == "compressed"
+
+    _, headers, body = call_app(app, "/ok", HTTP_ACCEPT_ENCODING="gzip;q=0")
+    assert "Content-Encoding" not in headers
+    assert headers["Vary"] == "Accept-Encoding"
+    assert body.startswith("<b>ok")
+
+    status, _, _ = call_app(app, "/missing")
+    assert status == "404 Not Found"
+
+    # compressed by blocks, not lines
+    open("%s/lines.txt" % tempdir, "wb").write("line\n" * 5000)
+    app.route("/lines")(lambda x: x.response.send_file("%s/lines.txt" % tempdir))
+    app.config["compress"] = True
+
+    def start_response(status, headers):
+        assert dict(headers)["Content-Encoding"] == "gzip"
+    # endfold
+
+    chunks = list(app({
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": "/lines",
+        "QUERY_STRING": "",
+        "HTTP_ACCEPT_ENCODING": "gzip",
+    }, start_response))
+    assert len(chunks) == 2
+    assert len("".join(chunks)) < 1000
+    assert zlib.decompress("".join(chunks), 16 + zlib.MAX_WBITS) == "line\n" * 5000
+
+
 def test_Application_exception():
     app = natrix.Application([
         ("/", lambda x: x.response("" + 1)),
@@ -608,6 +1489,34 @@ def test_Application_exception():
     natrix.error = natrix_error
 
 
+def test_Application_exception_body(monkeypatch):
+    """ Error log does not parse request body, it can abort """
+    def broken(x):
+        raise ValueError("broken")
+    # endfold
+
+    app = natrix.Application([
+        ("/", broken),
+    ])
+    app.config["request-max-size"] = 10
+    logged = []
+    monkeypatch.setattr(natrix, "error", lambda message, **kwargs: logged.append(message))
+
+    # too large body
+    status, _, _ = call_app(app, "/", QUERY_STRING="a=b", CONTENT_LENGTH="100",
+                            CONTENT_TYPE="application/x-www-form-urlencoded",
+                            **{"wsgi.input": StringIO("a" * 100)})
+    assert status == "500 Internal Server Error"
+    assert logged[-1].startswith("Error occured. GET http://")
+    assert "\na=b\n" in logged[-1]
+
+    # malformed multipart body
+    status, _, _ = call_app(app, "/", CONTENT_LENGTH="5",
+                            CONTENT_TYPE="multipart/form-data; boundary=xyz",
+                            **{"wsgi.input": StringIO("hello")})
+    assert status == "500 Internal Server Error"
+
+
 def test_route_before(tempdir):
     # before override
     app = natrix.Application([
@@ -645,6 +1554,61 @@ def test_route_before(tempdir):
     assert response.content_type == "text/custom"
 
 
+def test_route_before_priority():
+    app = natrix.Application([
+        ("/ok", lambda x: x.response(x.request.context)),
+    ])
+
+    @app.route(":before", priority=2)
+    def second(x):
+        x.request.context.append("second")
+
+    @app.route(":before", priority=0)
+    def first(x):
+        x.request.context = ["first"]
+
+    @app.route(":before", priority=2)
+    def third(x):
+        x.request.context.append("third")
+    # endfold
+
+    assert [h for _, h in app.special[":before"]] == [first, second, third]
+
+    testapp = webtest.TestApp(app)
+
+    response = testapp.get("/ok")
+    assert response.normal_body == "['first', 'second', 'third']"
+
+
+def test_route_lazy(tempdir):
+    os.mkdir("%s/lazyplugin" % tempdir)
+    open("%s/lazyplugin/__init__.py" % tempdir, "w+").write("")
+    open("%s/lazyplugin/handlers.py" % tempdir, "w+").write(
+        "def hello(x):\n"
+        "    x.response('lazy hello')\n",
+    )
+    sys.path.insert(0, tempdir)
+
+    app = natrix.Application()
+    handler = app.route("/hello", "lazyplugin:hello")
+    app.route("/hello2", "lazyplugin:hello")
+    assert "lazyplugin.handlers" not in sys.modules
+    assert repr(handler) == "<LazyHandler lazyplugin.handlers:hello>"
+
+    testapp = webtest.TestApp(app)
+    response = testapp.get("/hello")
+    assert response.normal_body == "lazy hello"
+    assert "lazyplugin.handlers" in app.import_times
+
+    # eager preload
+    assert app.preload() == app.import_times
+    assert app.routes[1][2].handler is not None
+
+    sys.path.remove(tempdir)
+    del sys.modules["lazyplugin.handlers"]
+    del sys.modules["lazyplugin"]
+
+
 def test_route_error():
     app = natrix.Application([
         ("/500", lambda x: x.response(None.None)),
@@ -742,8 +1706,250 @@ def test_route_shortcut():
     response = testapp.get("/123/abcd", status=404)
     assert response.status_int == 404
 
+    # compiled route table rebuilt after shortcut change
+    app.config["route-shortcut"] = {
+        "{custom}": "(xyz)",
+    }
+    response = testapp.get("/123/xyz")
+    assert response.normal_body == "u'xyz'"
+
+    response = testapp.get("/123/abc", status=404)
+    assert response.status_int == 404
+
+
+def test_route_engine():
+    for engine in ["regex", "trie", "alternation"]:
+        app = natrix.Application([
+            (0, "/", lambda x: x.response("home")),
+            (1, "/item/<int>", lambda x, a: x.response(repr(a))),
+            (1, "/item/(new|edit)", lambda x, a: x.response("regex %s" % a)),
+            (2, "/item/new", lambda x: x.response("literal")),
+            (2, "/item/all", lambda x: x.response("all")),
+            (3, "/item/<string>", lambda x, a: x.response(repr(a))),
+            (1, "/item/<int>#post", lambda x, a: x.response("post %s" % a)),
+            (4, "/(?i)upper/(\\w+)", lambda x, a: x.response("upper %s" % a)),
+            (5, "/(\\w+)/(\\w+)", lambda x, a, b: x.response("%s-%s" % (a, b))),
+        ])
+        app.config["route-engine"] = engine
+        testapp = webtest.TestApp(app)
+
+        assert testapp.get("/").normal_body == "home"
+        assert testapp.get("/item/12").normal_body == "12"
+        assert testapp.get("/item/new").normal_body == "regex new"
+        assert testapp.get("/item/all").normal_body == "all"
+        assert testapp.get("/item/abc").normal_body == "u'abc'"
+        assert testapp.post("/item/12").normal_body == "post 12"
+        assert testapp.head("/item/12").status_int == 200
+
+        assert testapp.get("/UPPER/x").normal_body == "upper x"
+        assert testapp.get("/a/b").normal_body == "a-b"
+
+        testapp.get("/item/12/more", status=404)
+        testapp.get("/item/", status=404)
+
+    # many routes split into several alternations
+    app = natrix.Application([
+        ("/%d/(\\d+)/(\\d+)" % i, lambda x, a, b, i=i: x.response("%s %s %s" % (i, a, b)))
+        for i in range(120)
+    ])
+    app.config["route-engine"] = "alternation"
+    testapp = webtest.TestApp(app)
+
+    assert testapp.get("/0/1/2").normal_body == "0 1 2"
+    assert testapp.get("/119/3/4").normal_body == "119 3 4"
+
+
+def test_route_freeze():
+    app = natrix.Application()
+    for i in range(3):
+        app.route("/(.*)", priority=2)(lambda x, a, i=i: x.response("any %s" % i))
+    app.route("/b")(lambda x: x.response("b"))
+    app.route("/a", priority=0)(lambda x: x.response("a"))
+
+    # not ordered until freeze
+    assert [r[1] for r in app.routes] == ["/(.*)", "/(.*)", "/(.*)", "/b", "/a"]
+
+    app.freeze()
+    assert [r[1] for r in app.routes] == ["/a", "/b", "/(.*)", "/(.*)", "/(.*)"]
+
+    testapp = webtest.TestApp(app)
+    assert testapp.get("/a").normal_body == "a"
+    assert testapp.get("/b").normal_body == "b"
+    assert testapp.get("/c").normal_body == "any 0"
+
+
+def test_route_cache():
+    app = natrix.Application([
+        ("/1", lambda x: x.response("one")),
+        ("/2/<int>", lambda x, a: x.response(repr(a))),
+    ])
+    app.config["route-cache-size"] = 2
+    testapp = webtest.TestApp(app)
+
+    assert testapp.get("/2/5").normal_body == "5"
+    assert testapp.get("/2/5").normal_body == "5"
+    assert app.resolve(u"/1/", "GET") == (None, None, u"/1")
+    assert app.resolve(u"/3", "GET") == (None, None, None)
+
+    # bounded
+    assert len(app._resolved.items) == 2
+    assert (u"/2/5", "GET") not in app._resolved.items
+
+    response = testapp.get("/1/?a=b")
+    assert response.location == "/1?a=b"
+    assert response.status_int == 301
+
+    # dropped after route change
+    app.route("/3")(lambda x: x.response("three"))
+    assert testapp.get("/3").normal_body == "three"
+
+
+def test_route_cache_rebuild(monkeypatch):
+    app = natrix.Application([("/2", lambda x: x.response("two"))])
+
+    # slow build: concurrent resolve must not see router without cache
+    lru_cache = natrix.LRUCache
+    monkeypatch.setattr(natrix, "LRUCache", lambda size: time.sleep(0.05) or lru_cache(size))
+
+    errors = []
+
+    def resolve():
+        try:
+            assert app.resolve(u"/2", "GET")[0]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=resolve) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
 
 # Helpers
+def test_Cookies(monkeypatch):
+    cookies = natrix.Cookies('a=1; b="x\\054y"; $Version=1; c:d=2; e=3')
+    assert cookies["a"].value == "1"
+    assert cookies.morsels.keys() == ["a"]  # only decoded cookie
+    assert cookies["b"].value == "x,y"
+    assert "e" in cookies
+    assert "f" not in cookies
+
+    monkeypatch.setattr(natrix, "info", lambda x: x)
+    assert "c:d" not in cookies
+    assert sorted(cookies.keys()) == ["a", "b", "e"]
+
+    cookies["f"] = "4"
+    del cookies["a"]
+    assert sorted(cookies.keys()) == ["b", "e", "f"]
+    assert len(cookies) == 3
+
+
+def test_compile_rule():
+    methods, pattern, converters, segments = natrix.compile_rule("/<int>/<string>")
+    assert methods == frozenset(["GET", "HEAD"])
+    assert pattern.match("/12/hello").groups() == ("12", "hello")
+    assert converters == [int, None]
+    assert segments == ["", natrix.PLACEHOLDER_INT, natrix.PLACEHOLDER_STRING]
+
+    methods, pattern, converters, segments = natrix.compile_rule("/{x}#post", {"{x}": "(a|b)"})
+    assert methods == frozenset(["POST"])
+    assert pattern.match("/a")
+    assert not pattern.match("/c")
+    assert converters == [None]
+    assert segments is None
+
+    # literal segments only
+    _, _, _, segments = natrix.compile_rule("/page.html")
+    assert segments is None
+
+    _, _, _, segments = natrix.compile_rule(u"/юникод/ok-1")
+    assert segments == ["", u"юникод", "ok-1"]
+
+
+def test_LRUCache():
+    cache = natrix.LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    cache.clear()
+    assert cache.get("a", 0) == 0
+
+    cache = natrix.LRUCache(0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+    # shared by threads
+    cache = natrix.LRUCache(8)
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(2000):
+                cache.set((n, i % 16), i)
+                cache.get((n, (i + 1) % 16))
+        except Exception as e:  # noqa: B902
+            errors.append(e)
+    # endfold
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(cache.items) <= 8
+
+
+def test_header_list():
+    headers = {
+        "Content-Length": 12,
+        "Location": u"/юникод",
+        "Set-Cookie": ["a=1", "b=2"],
+        "X-Plain": "a b\tc",
+    }
+    assert sorted(natrix.header_list(headers)) == [
+        ("Content-Length", "12"),
+        ("Location", "/%D1%8E%D0%BD%D0%B8%D0%BA%D0%BE%D0%B4"),
+        ("Set-Cookie", "a=1"),
+        ("Set-Cookie", "b=2"),
+        ("X-Plain", "a b\tc"),
+    ]
+
+
+def test_parse_accept_encoding():
+    assert natrix.parse_accept_encoding("") == {}
+    assert natrix.parse_accept_encoding("gzip, deflate;q=0.5, br; q=0") == {
+        "gzip": 1.0,
+        "deflate": 0.5,
+        "br": 0.0,
+    }
+    assert natrix.parse_accept_encoding("*;q=x") == {"*": 0.0}
+
+
+def test_parse_range():
+    assert natrix.parse_range("bytes=0-0", 10) == [(0, 1)]
+    assert natrix.parse_range("bytes=-3, 2-4", 10) == [(2, 5), (7, 10)]
+    assert natrix.parse_range("bytes=2-, -3", 10) == [(2, 10)]
+    assert natrix.parse_range("bytes=0-1, 2-3, 5-6, 6-8", 10) == [(0, 4), (5, 9)]
+    assert natrix.parse_range("bytes=" + ",".join(["0-"] * 16), 10) == [(0, 10)]
+    assert natrix.parse_range("bytes=" + ",".join(["0-"] * 17), 10) is None
+    assert natrix.parse_range("bytes=-20", 10) == [(0, 10)]
+    assert natrix.parse_range("bytes=10-", 10) == []
+    assert natrix.parse_range("bytes=5-2", 10) is None
+    assert natrix.parse_range("bytes=a-b", 10) is None
+    assert natrix.parse_range("items=0-1", 10) is None
+
+
 def test_ensure_unicode():
     assert natrix.ensure_unicode("\xf4\xee") == u"\xf4\xee"
     assert natrix.ensure_unicode("ab\xf4\xee") == u"ab\xf4\xee"
@@ -889,6 +2095,81 @@ def test_app(tempdir):
     assert response.content_type == "text/html"
 
 
+def test_compile_templates(tempdir):
+    target = "%s/compiled" % tempdir
+    open("%s/filter.html" % tempdir, "w+").write("{{ 'a'|shout }}")
+
+    def compile_templates(*args):
+        argv, stdout, stderr = sys.argv, sys.stdout, sys.stderr
+        sys.argv = ["natrix.py", "compile-templates"] + list(args)
+        sys.stdout = sys.stderr = StringIO()
+        try:
+            natrix._compile_templates()
+        finally:
+            output = sys.stdout.getvalue()
+            sys.argv, sys.stdout, sys.stderr = argv, stdout, stderr
+        return output
+    # endfold
+
+    # unknown filter fails at build time
+    with pytest.raises(SystemExit):
+        compile_templates("--template-path=%s" % tempdir, "--target=%s" % target)
+
+    output = compile_templates("--template-path=%s" % tempdir, "--target=%s" % target,
+                               "--filters=shout")
+    assert 'Compiled "ok.html"' in output
+    assert 'Compiled "filter.html"' in output
+
+    # sources are not used
+    shutil.move("%s/ok.html" % tempdir, "%s/ok.txt" % tempdir)
+
+    app = natrix.Application([
+        ("/<string>", lambda x, name: x.render("%s.html" % name)),
+    ], config={
+        "context": {"shout": lambda s: s.upper()},
+    })
+    app.config["template-path"] = tempdir
+    app.config["template-compiled"] = target
+    testapp = webtest.TestApp(app)
+
+    response = testapp.get("/ok")
+    assert response.normal_body == "<b>ok хорошо /ok</b>"
+    response = testapp.get("/filter")
+    assert response.normal_body == "A"
+
+    # syntax error
+    open("%s/error.html" % tempdir, "w+").write("{% if %}")
+    with pytest.raises(SystemExit):
+        compile_templates("--template-path=%s" % tempdir, "--target=%s" % target,
+                          "--filters=shout")
+
+
+def test_compile_templates_cli(tempdir, testbed):
+    """ Command line run as `__main__` module """
+    target = "%s/compiled" % tempdir
+    open("%s/tags.html" % tempdir, "w+").write(
+        "<head>{% flush %}{% cache 'body' %}body{% endcache %}",
+    )
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.check_output([
+        sys.executable, natrix.__file__.replace(".pyc", ".py"), "compile-templates",
+        "--template-path=%s" % tempdir, "--target=%s" % target,
+    ], env=env, stderr=subprocess.STDOUT)
+
+    app = natrix.Application([
+        ("/", lambda x: x.render("tags.html")),
+        ("/stream", lambda x: x.render_stream("tags.html")),
+    ])
+    app.config["template-path"] = tempdir
+    app.config["template-compiled"] = target
+
+    assert call_app(app, "/")[2] == "<head>body"
+
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/stream", "QUERY_STRING": ""}
+    assert list(app(environ, lambda status, headers: None)) == ["<head>", "body"]
+
+
 def test_google_appengine_shortcuts():
     assert str(natrix.db)[9:].startswith("google.appengine.ext.db")
     assert str(natrix.memcache)[9:].startswith("google.appengine.api.memcache")